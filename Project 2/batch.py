@@ -0,0 +1,325 @@
+"""
+Explain a workload of queries without the interface, e.g. every night.
+
+The workload is read from .sql files, one query per file, directories of
+.sql files and .jsonl files with one {"sql": ..., "database": ..., "name": ...}
+object per line. "database" and "name" are optional. The queries are
+explained on a pool of processes that share their relation statistics, and
+the results are written to report.json and report.md. Run with
+
+    python batch.py queries/ workload.jsonl --database tpch --out reports/
+
+See python batch.py --help for the connection and EXPLAIN options.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import time
+
+from explain import (
+    EXPLAIN_ANALYZE,
+    ESTIMATE_ONLY,
+    FULL_DIAGNOSTICS,
+    GENERIC_PLAN,
+    LOW_OVERHEAD,
+    LoginDetails,
+    QueryCancelled,
+    QueryDetails,
+    initialize_tree,
+    load_qep_explanations,
+    retrieve_plan,
+    stats_cache,
+)
+
+# The EXPLAIN profiles selectable with --mode, as in the interface's mode selector
+MODES = {
+    "analyze": EXPLAIN_ANALYZE,
+    "low-overhead": LOW_OVERHEAD,
+    "full": FULL_DIAGNOSTICS,
+    "estimate": ESTIMATE_ONLY,
+    "generic": GENERIC_PLAN,
+}
+
+
+def load_workload(paths, database):
+    """
+    Read the queries to explain
+
+    @param paths: .sql files, directories of .sql files and .jsonl files
+    @param database: The database of queries that do not name one
+    @return: A list of {"name", "database", "sql"} dicts, in the order given
+    """
+    workload = []
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(
+                os.path.join(path, name) for name in os.listdir(path) if name.endswith(".sql")
+            )
+        else:
+            files = [path]
+
+        for file in files:
+            with open(file, encoding="utf-8") as f:
+                if not file.endswith(".jsonl"):
+                    workload.append(
+                        {"name": os.path.basename(file), "database": database, "sql": f.read()}
+                    )
+                    continue
+
+                for line_number, line in enumerate(f, 1):
+                    if not line.strip():
+                        continue
+                    entry = json.loads(line)
+                    workload.append(
+                        {
+                            "name": entry.get("name", f"{os.path.basename(file)}:{line_number}"),
+                            "database": entry.get("database", database),
+                            "sql": entry["sql"],
+                        }
+                    )
+    return workload
+
+
+######### Worker processes #########
+
+# Settings of the batch, set in every worker process by init_worker()
+_config = {}
+
+
+def init_worker(login_details, options, statement_timeout, exact_counts, verbose, shared_stats):
+    """
+    Initializer of the worker processes
+
+    @param shared_stats: A dict shared by every process through a
+                         multiprocessing manager, see explain_item()
+    """
+    _config.update(
+        login_details=login_details,
+        options=options,
+        statement_timeout=statement_timeout,
+        exact_counts=exact_counts,
+        verbose=verbose,
+        shared_stats=shared_stats,
+    )
+
+
+def explain_item(item):
+    """
+    Run and explain one query of the workload in a worker process.
+
+    The relation statistics other processes already fetched are loaded into
+    this process's stats_cache first, and the ones fetched for this query are
+    shared afterwards, so that each relation is only looked up once per batch.
+
+    @param item: A dict of the workload, see load_workload()
+    @return: The result as a dict. "status" is "ok", "failed", "timeout", "cancelled" or "error"
+    """
+    shared_stats = _config["shared_stats"]
+    stats_cache.update(dict(shared_stats))
+
+    result = dict(item)
+    start = time.perf_counter()
+    try:
+        # retrieve_query prints the query and its whole output
+        if _config["verbose"]:
+            output = contextlib.nullcontext(sys.stdout)
+        else:
+            output = open(os.devnull, "w")
+        with output as f, contextlib.redirect_stdout(f):
+            result.update(explain_query(item))
+    except QueryCancelled as e:
+        result.update(status="timeout" if e.timed_out else "cancelled", error=str(e))
+    except Exception as e:
+        result.update(status="error", error=f"{type(e).__name__}: {e}")
+    result["seconds"] = time.perf_counter() - start
+
+    # Only send back what the other processes do not have yet
+    shared_stats.update(
+        {key: value for key, value in stats_cache.snapshot().items() if key not in shared_stats}
+    )
+    return result
+
+
+def explain_query(item):
+    """
+    @return: The fields of the result of a query that ran
+    """
+    query_details = QueryDetails(database=item["database"], query=item["sql"])
+    qep, _ = retrieve_plan(
+        _config["login_details"],
+        query_details,
+        _config["options"],
+        _config["statement_timeout"],
+        refresh=True,
+    )
+    if not qep:
+        return {"status": "failed", "error": "The query failed, see the server log"}
+
+    tree = initialize_tree(
+        qep[0][0][0]["Plan"],
+        _config["login_details"],
+        query_details,
+        _config["exact_counts"],
+        _config["options"],
+        qep[0][0][0],
+    )
+    explanation = load_qep_explanations(tree)
+    return {
+        "status": "ok",
+        "planning_ms": tree.summary.get("Planning Time"),
+        "execution_ms": tree.summary.get("Execution Time"),
+        "total_cost": tree.root.node_json.get("Total Cost"),
+        "nodes": sum(1 for _ in tree.iter_nodes()),
+        "explanation": explanation,
+        "plan": qep[0][0][0],
+    }
+
+
+######### Reports #########
+
+
+def summarize(results, elapsed, workers, shared_stats):
+    """
+    @param shared_stats: The number of statistics entries the processes shared
+    @return: The throughput summary of the batch as a dict
+    """
+    seconds = sorted(result["seconds"] for result in results)
+    summary = {
+        "queries": len(results),
+        "workers": workers,
+        "wall_seconds": elapsed,
+        "queries_per_second": len(results) / elapsed if elapsed else 0.0,
+        "statuses": {},
+        "mean_seconds": statistics.mean(seconds) if seconds else 0.0,
+        "median_seconds": statistics.median(seconds) if seconds else 0.0,
+        "p95_seconds": seconds[min(len(seconds) - 1, int(len(seconds) * 0.95))] if seconds else 0.0,
+        "shared_stats": shared_stats,
+    }
+    for result in results:
+        summary["statuses"][result["status"]] = summary["statuses"].get(result["status"], 0) + 1
+    return summary
+
+
+def write_json_report(path, results, summary):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"summary": summary, "results": results}, f, indent=2, default=str)
+
+
+def write_markdown_report(path, results, summary):
+    lines = [
+        "# Query plan explanations",
+        "",
+        f"{summary['queries']} queries on {summary['workers']} processes in "
+        f"{summary['wall_seconds']:.2f} s ({summary['queries_per_second']:.2f} queries/s)",
+        "",
+        "| Query | Database | Status | Total Cost | Execution Time (ms) | Nodes | Seconds |",
+        "| --- | --- | --- | --- | --- | --- | --- |",
+    ]
+    for result in results:
+        values = (
+            result["name"],
+            result["database"],
+            result["status"],
+            result.get("total_cost"),
+            result.get("execution_ms"),
+            result.get("nodes"),
+            f"{result['seconds']:.2f}",
+        )
+        lines.append("| " + " | ".join("" if value is None else str(value) for value in values) + " |")
+
+    for result in results:
+        lines += ["", f"## {result['name']}", "", "```sql", result["sql"].strip(), "```", ""]
+        if result["status"] == "ok":
+            lines += ["```", result["explanation"], "```"]
+        else:
+            lines.append(f"{result['status']}: {result.get('error', '')}")
+
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def print_summary(summary):
+    statuses = ", ".join(f"{count} {status}" for status, count in sorted(summary["statuses"].items()))
+    print(
+        f"\n{summary['queries']} queries in {summary['wall_seconds']:.2f} s on "
+        f"{summary['workers']} processes: {summary['queries_per_second']:.2f} queries/s"
+    )
+    print(f"Status: {statuses}")
+    print(
+        f"Time per query: mean {summary['mean_seconds']:.2f} s, "
+        f"median {summary['median_seconds']:.2f} s, p95 {summary['p95_seconds']:.2f} s"
+    )
+    print(f"Shared statistics entries: {summary['shared_stats']}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Explain the query plans of a workload of SQL queries")
+    parser.add_argument("paths", nargs="+", help=".sql files, directories of .sql files or .jsonl workloads")
+    parser.add_argument("--database", "-d", help="Database of the queries that do not name one")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", default="5432")
+    parser.add_argument("--user", default="postgres")
+    parser.add_argument(
+        "--password", default=os.environ.get("PGPASSWORD", ""), help="Defaults to $PGPASSWORD"
+    )
+    parser.add_argument("--mode", choices=MODES, default="analyze", help="EXPLAIN options to use")
+    parser.add_argument("--timeout", type=int, default=300, help="Statement timeout in seconds, 0 for none")
+    parser.add_argument("--exact-counts", action="store_true", help="Count tuples by scanning the relations")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of processes")
+    parser.add_argument("--out", default=".", help="Directory of report.json and report.md")
+    parser.add_argument("--verbose", action="store_true", help="Print the queries and their output")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workload = load_workload(args.paths, args.database)
+    missing = [item["name"] for item in workload if not item["database"]]
+    if missing:
+        sys.exit(f"No database for {', '.join(missing)}, use --database")
+
+    login_details = LoginDetails(host=args.host, port=args.port, user=args.user, password=args.password)
+    workers = max(1, min(args.workers, len(workload)))
+    results = [None] * len(workload)
+
+    start = time.perf_counter()
+    with multiprocessing.Manager() as manager:
+        shared_stats = manager.dict()
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_worker,
+            initargs=(
+                login_details,
+                MODES[args.mode],
+                args.timeout * 1000 or None,
+                args.exact_counts,
+                args.verbose,
+                shared_stats,
+            ),
+        ) as executor:
+            futures = {executor.submit(explain_item, item): index for index, item in enumerate(workload)}
+            for done, future in enumerate(as_completed(futures), 1):
+                index = futures[future]
+                result = results[index] = future.result()
+                print(
+                    f"[{done}/{len(workload)}] {result['name']}: "
+                    f"{result['status']} ({result['seconds']:.2f} s)"
+                )
+        num_shared_stats = len(shared_stats)
+    summary = summarize(results, time.perf_counter() - start, workers, num_shared_stats)
+
+    os.makedirs(args.out, exist_ok=True)
+    write_json_report(os.path.join(args.out, "report.json"), results, summary)
+    write_markdown_report(os.path.join(args.out, "report.md"), results, summary)
+    print_summary(summary)
+    return 0 if summary["statuses"].get("ok", 0) == len(results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,152 @@
+"""
+Benchmarks of the query plan tree on synthetic plans.
+
+They do not connect to the database, only the parts of explain.py that
+do not depend on it are measured. Run with
+
+    python benchmark.py
+"""
+
+import sys
+import time
+import tracemalloc
+
+from explain import LoginDetails, QueryDetails, Tree
+
+# The tree is only built and traversed, these are never used to connect
+LOGIN_DETAILS = LoginDetails(host="localhost", port="5432", user="postgres", password="")
+QUERY_DETAILS = QueryDetails(database="benchmark", query="")
+
+
+def scan_plan(relation):
+    """
+    @param relation: The name of the scanned relation
+    @return: The JSON of a sequential scan
+    """
+    return {
+        "Node Type": "Seq Scan",
+        "Relation Name": relation,
+        "Alias": relation,
+        "Startup Cost": 0.0,
+        "Total Cost": 10.0,
+        "Plan Rows": 100,
+        "Plan Width": 8,
+    }
+
+
+def deep_plan(num_joins):
+    """
+    Build the JSON of a left-deep chain of nested loop joins, the deepest
+    shape a plan can have. It has num_joins joins and num_joins + 1 scans.
+
+    @param num_joins: The number of joins in the plan
+    @return: The value of the key "Plan"
+    """
+    plan = scan_plan("t0")
+    for i in range(1, num_joins + 1):
+        plan = {
+            "Node Type": "Nested Loop",
+            "Join Type": "Inner",
+            "Startup Cost": 0.0,
+            "Total Cost": 10.0 * (i + 1),
+            "Plan Rows": 100,
+            "Plan Width": 8 * (i + 1),
+            "Plans": [plan, scan_plan("t" + str(i))],
+        }
+    return plan
+
+
+def partitioned_plan(num_partitions):
+    """
+    Build the JSON of an Append over num_partitions partition scans, the
+    widest shape a plan can have.
+
+    @param num_partitions: The number of children of the Append
+    @return: The value of the key "Plan"
+    """
+    return {
+        "Node Type": "Append",
+        "Startup Cost": 0.0,
+        "Total Cost": 10.0 * num_partitions,
+        "Plan Rows": 100 * num_partitions,
+        "Plan Width": 8,
+        "Plans": [scan_plan("p" + str(i)) for i in range(num_partitions)],
+    }
+
+
+def bench_tree(make_plan, sizes=(1000, 2000, 4000, 8000, 16000, 32000)):
+    """
+    Time the construction of the tree, the subtree hashes included, and a
+    pre-order and post-order traversal for plans of increasing size. The
+    time per node should stay roughly constant.
+
+    @param make_plan: deep_plan or partitioned_plan
+    @param sizes: The sizes of the plans to pass to make_plan
+    """
+    print(make_plan.__name__)
+    print("nodes      build (s)  traverse (s)  us/node")
+    for size in sizes:
+        plan = make_plan(size)
+
+        tree = Tree(LOGIN_DETAILS, QUERY_DETAILS)
+        start = time.perf_counter()
+        tree.build_tree(plan)
+        built = time.perf_counter()
+        num_nodes = sum(1 for _ in tree.iter_nodes())
+        tree.post_order()
+        traversed = time.perf_counter()
+
+        print(
+            f"{num_nodes:<10} {built - start:<10.3f} {traversed - built:<13.3f} "
+            f"{(traversed - start) / num_nodes * 1e6:.1f}"
+        )
+
+
+def bench_memory(make_plan, size=32000):
+    """
+    Measure the memory a tree adds to its plan JSON and the peak while
+    building it, and the time to build it. The parent_dict of every node is
+    filled in and merged into its parent as when explaining, without the
+    database queries.
+
+    The plan JSON stays referenced, as in the interface where plan_cache
+    holds it for as long as the tree is shown.
+
+    @param make_plan: deep_plan or partitioned_plan
+    @param size: The size of the plan to pass to make_plan
+    """
+    tracemalloc.start()
+    plan = make_plan(size)
+    plan_size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+
+    tree = Tree(LOGIN_DETAILS, QUERY_DETAILS)
+    start = time.perf_counter()
+    tree.build_tree(plan)
+    for node in reversed(list(tree.iter_nodes())):
+        node.merge_dict()
+        node.parent_dict = {
+            "Node Type": node.node_json["Node Type"],
+            "block_size": 10,
+            "tuple_size": 100,
+            "manual_cost": 10,
+            "postgre_cost": node.node_json["Total Cost"],
+        }
+    elapsed = time.perf_counter() - start
+    held, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    num_nodes = sum(1 for _ in tree.iter_nodes())
+    print(
+        f"{make_plan.__name__}: {num_nodes} nodes, plan JSON {plan_size / 2**20:.1f} MiB, "
+        f"tree {(held - plan_size) / 2**20:.1f} MiB more, peak {(peak - plan_size) / 2**20:.1f} MiB more, "
+        f"{elapsed:.3f} s"
+    )
+
+
+if __name__ == "__main__":
+    print("Python recursion limit:", sys.getrecursionlimit())
+    bench_tree(deep_plan)
+    bench_tree(partitioned_plan)
+    bench_memory(deep_plan)
+    bench_memory(partitioned_plan)
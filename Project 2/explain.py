@@ -1,107 +1,1861 @@
+import asyncio
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import asdict, dataclass, replace
 from math import sqrt
+import hashlib
+import json
+import os
+import queue
+import re
+import tempfile
+import threading
+import time
+import weakref
 import numpy as np
 import psycopg2
-from typing import TypedDict, List
+import psycopg2.extensions
+import psycopg2.extras
+from typing import List
 
 
-class LoginDetails(TypedDict):
+@dataclass(frozen=True)
+class LoginDetails:
+    """
+    Connection parameters entered on the login page. Immutable, so that one
+    object can be shared by every request running at the same time
+
+    @param host: Host name or address of the PostgreSQL server
+    @param port: Port of the PostgreSQL server
+    @param user: User to log in as
+    @param password: Password of the user
+    """
+
     host: str
     port: int
     user: str
     password: str
 
 
-class QueryDetails(TypedDict):
-    database: str
-    query: str
+@dataclass(frozen=True)
+class QueryDetails:
+    """
+    The database and SQL of one request. Immutable, every request gets its
+    own object, so explanations running at the same time cannot overwrite
+    each other's query. Use dataclasses.replace() to derive another one
+
+    @param database: Name of the database to run the query on
+    @param query: The SQL string to execute
+    """
+
+    database: str
+    query: str
+
+
+@dataclass(frozen=True)
+class ExplainOptions:
+    """
+    Options of the EXPLAIN statement that retrieve_query runs
+
+    TIMING, WAL and SUMMARY only apply to EXPLAIN ANALYZE and are left out
+    of the statement otherwise. Use the profiles below for common setups.
+
+    @param analyze: Execute the query to measure actual rows and times
+    @param timing: Measure the time spent in every node. This instrumentation
+                   can add a large overhead on queries returning many rows
+    @param buffers: Report shared, local and temporary buffer usage
+    @param settings: Report the settings that differ from their defaults
+    @param wal: Report the WAL records generated by the query
+    @param summary: Report planning and execution time. None uses the server default
+    @param generic_plan: Plan parameterized SQL ($1, $2, ...) without values.
+                         Requires PostgreSQL 16 and analyze=False
+    """
+
+    analyze: bool = True
+    timing: bool = True
+    buffers: bool = False
+    settings: bool = False
+    wal: bool = False
+    summary: bool = None
+    generic_plan: bool = False
+
+    def to_sql(self) -> str:
+        """
+        @return: The EXPLAIN prefix to prepend to the query
+        """
+        options = []
+        if self.analyze:
+            options.append("ANALYZE")
+            if not self.timing:
+                options.append("TIMING OFF")
+            if self.wal:
+                options.append("WAL")
+        elif self.generic_plan:
+            options.append("GENERIC_PLAN")
+        options.append("VERBOSE")
+        if self.buffers:
+            options.append("BUFFERS")
+        if self.settings:
+            options.append("SETTINGS")
+        if self.summary is not None:
+            options.append("SUMMARY" if self.summary else "SUMMARY OFF")
+        options.append("FORMAT JSON")
+        return "EXPLAIN (" + ", ".join(options) + ")"
+
+
+# Executes the query with per-node timing, the historical default
+EXPLAIN_ANALYZE = ExplainOptions()
+
+# Executes the query but skips the per-node clock reads
+LOW_OVERHEAD = ExplainOptions(timing=False, summary=True)
+
+# Executes the query and reports everything PostgreSQL can measure
+FULL_DIAGNOSTICS = ExplainOptions(buffers=True, settings=True, wal=True, summary=True)
+
+# Only plans the query, nothing is executed
+ESTIMATE_ONLY = ExplainOptions(analyze=False)
+
+# Only plans parameterized SQL, nothing is executed
+GENERIC_PLAN = ExplainOptions(analyze=False, generic_plan=True)
+
+
+class PoolTimeout(psycopg2.OperationalError):
+    """
+    Raised when no pooled connection becomes available within the wait timeout
+    """
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of psycopg2 connections for one (host, port, user, database)
+
+    Idle connections are reused in LIFO order so that the most recently used,
+    and therefore most likely healthy, connection is handed out first.
+    Connections idle for longer than max_idle are closed, as long as at least
+    min_size connections are kept open.
+
+    @param login_details: User-provided login details to the UI
+    @param databasename: The database to connect to. None connects to the server default
+    @param min_size: Number of idle connections that are never evicted
+    @param max_size: Maximum number of connections open at the same time
+    @param max_idle: Seconds a connection may stay idle before it is evicted
+    @param check_after: Seconds a connection may stay idle before it is health-checked on borrow
+    @param timeout: Seconds to wait for a free connection before raising PoolTimeout
+    """
+
+    def __init__(
+        self,
+        login_details: LoginDetails,
+        databasename=None,
+        min_size=1,
+        max_size=10,
+        max_idle=300,
+        check_after=30,
+        timeout=30,
+    ):
+        self.login_details = login_details
+        self.databasename = databasename
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self.timeout = timeout
+
+        # Stack of (connection, time it was returned)
+        self._idle = []
+
+        # Number of connections currently open, both idle and borrowed
+        self._size = 0
+        self._cond = threading.Condition()
+
+        # Counters used to size the pool
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.evicted = 0
+        self.discarded = 0
+
+    def _connect(self):
+        return psycopg2.connect(
+            host=self.login_details.host,
+            port=self.login_details.port,
+            user=self.login_details.user,
+            password=self.login_details.password,
+            dbname=self.databasename if self.databasename else "",
+        )
+
+    @staticmethod
+    def _is_healthy(conn):
+        """
+        Run a trivial query to make sure the server side of the connection is still alive
+        """
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _evict_idle(self, now):
+        """
+        Close connections that stayed idle for longer than max_idle.
+        Must be called while holding self._cond
+        """
+        keep = []
+        for conn, returned_at in self._idle:
+            if now - returned_at > self.max_idle and self._size > self.min_size:
+                self._close(conn)
+                self._size -= 1
+                self.evicted += 1
+            else:
+                keep.append((conn, returned_at))
+        self._idle = keep
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def getconn(self, timeout=None):
+        """
+        Borrow a connection from the pool, opening a new one if none are idle
+
+        @param timeout: Seconds to wait when the pool is exhausted. Defaults to self.timeout
+        @return: An open psycopg2 connection
+        """
+        timeout = self.timeout if timeout is None else timeout
+        start = time.monotonic()
+        waited = False
+
+        while True:
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    self._evict_idle(now)
+
+                    # Reuse the most recently returned connection. One that
+                    # stayed idle for a while is health-checked first, below
+                    if self._idle:
+                        conn, returned_at = self._idle.pop()
+                        if now - returned_at <= self.check_after and not conn.closed:
+                            self.hits += 1
+                            self._record_wait(waited, start)
+                            return conn
+                        break
+
+                    # Open a new connection if there is still room
+                    if self._size < self.max_size:
+                        self._size += 1
+                        conn = None
+                        break
+
+                    # Otherwise wait for another thread to return one
+                    remaining = timeout - (time.monotonic() - start)
+                    if remaining <= 0:
+                        self._record_wait(True, start)
+                        raise PoolTimeout(
+                            "No connection available in the pool after "
+                            + str(timeout)
+                            + " seconds"
+                        )
+                    waited = True
+                    self._cond.wait(remaining)
+
+            if conn is None:
+                break
+
+            # The health check is a round trip to a server that may not answer,
+            # run it outside of the lock so that other threads are not blocked.
+            # The connection still counts towards _size meanwhile
+            if self._is_healthy(conn):
+                with self._cond:
+                    self.hits += 1
+                    self._record_wait(waited, start)
+                return conn
+
+            self._close(conn)
+            with self._cond:
+                self._size -= 1
+                self.discarded += 1
+                self._cond.notify()
+
+        # Connect outside of the lock so that other threads are not blocked
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+        with self._cond:
+            self.misses += 1
+            self._record_wait(waited, start)
+        return conn
+
+    def _record_wait(self, waited, start):
+        if waited:
+            self.waits += 1
+            self.wait_time += time.monotonic() - start
+
+    def putconn(self, conn, discard=False):
+        """
+        Return a borrowed connection to the pool
+
+        @param conn: The connection obtained from getconn()
+        @param discard: Close the connection instead of keeping it for reuse
+        """
+        if not discard and not conn.closed:
+            # Never hand out a connection that is still inside a transaction
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                discard = True
+
+        with self._cond:
+            if discard or conn.closed:
+                self._close(conn)
+                self._size -= 1
+                self.discarded += 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        """
+        Close every idle connection. Borrowed connections are closed when returned
+        """
+        with self._cond:
+            for conn, _ in self._idle:
+                self._close(conn)
+                self._size -= 1
+            self._idle = []
+            self._cond.notify_all()
+
+    def stats(self):
+        """
+        @return: A dict of the pool counters, used to size min_size and max_size
+        """
+        with self._cond:
+            requests = self.hits + self.misses
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0.0,
+                "waits": self.waits,
+                "wait_time": self.wait_time,
+                "evicted": self.evicted,
+                "discarded": self.discarded,
+            }
+
+
+# One pool per (host, port, user, database), shared by the whole process
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(login_details: LoginDetails, databasename=None) -> ConnectionPool:
+    """
+    Return the shared connection pool for the given login details and database,
+    creating it on first use
+    """
+    key = (
+        login_details.host,
+        str(login_details.port),
+        login_details.user,
+        databasename if databasename else "",
+    )
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = ConnectionPool(login_details, databasename)
+            _pools[key] = pool
+        return pool
+
+
+def pool_stats():
+    """
+    @return: The counters of every pool, keyed by (host, port, user, database)
+    """
+    with _pools_lock:
+        pools = dict(_pools)
+    return {key: pool.stats() for key, pool in pools.items()}
+
+
+def close_all_pools():
+    """
+    Close every pooled connection, e.g. when the application exits
+    """
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.closeall()
+
+
+class DatabaseConnector(object):
+    """
+    Context manager that borrows a connection from the shared pool
+    and yields a cursor on it. The connection is returned on exit.
+    """
+
+    def __init__(self, login_details: LoginDetails, databasename=None):
+        self.pool = get_pool(login_details, databasename)
+        self.connection = self.pool.getconn()
+        self.connector = self.connection.cursor()
+
+    def __enter__(self):
+        return self.connector
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.connector.close()
+        self.pool.putconn(self.connection)
+
+
+class DatabaseSession(object):
+    """
+    A single pooled connection and cursor shared by every query issued
+    while explaining one query plan.
+
+    The connection is borrowed lazily on the first query and returned
+    to the pool by close(), so a Tree that never queries the database
+    never holds a connection.
+
+    @param login_details: User-provided login details to the UI
+    @param databasename: The database that the catalog queries run against
+    """
+
+    def __init__(self, login_details: LoginDetails, databasename=None):
+        self.login_details = login_details
+        self.databasename = databasename
+        self.pool = None
+        self.connection = None
+        self.cursor = None
+
+        # Number of queries executed on this session
+        self.queries = 0
+
+        # Snapshot of COST_SETTINGS, loaded on first use
+        self._settings = None
+
+        # Settings changed with set_setting(), by name
+        self._changed_settings = {}
+
+    def execute(self, query):
+        """
+        Execute a query on the session's cursor
+
+        @param query: The SQL string to execute
+        @return: All rows of the result, or None if the query failed
+        """
+        if self.cursor is None:
+            self.pool = get_pool(self.login_details, self.databasename)
+            self.connection = self.pool.getconn()
+            self.cursor = self.connection.cursor()
+
+        self.queries += 1
+        try:
+            self.cursor.execute(query)
+            return self.cursor.fetchall()
+        except psycopg2.Error:
+            # A failed statement aborts the transaction, reset it so the
+            # session stays usable for the next query
+            self.connection.rollback()
+            return None
+
+    @property
+    def settings(self):
+        """
+        Snapshot of the planner settings in COST_SETTINGS, read in one query
+        the first time it is needed and kept for the rest of the session
+        """
+        if self._settings is None:
+            self._settings = parse_settings(self.execute(SETTINGS_QUERY))
+        return self._settings
+
+    def seed_settings(self, rows):
+        """
+        Fill the settings snapshot from rows that were fetched as part of
+        another query, see Tree.prefetch_stats()
+        """
+        self._settings = parse_settings(rows)
+
+    def set_setting(self, name: str, value):
+        """
+        Change a setting for this session. The snapshot is re-read on next use
+        """
+        self.execute(
+            "SELECT set_config(" + quote_literal(name) + ", " + quote_literal(value) + ", false)"
+        )
+        self._settings = None
+        self._changed_settings[name] = value
+
+    def fork(self):
+        """
+        Open another session on the same database, e.g. for another thread.
+        It starts with this session's settings, including the ones changed
+        with set_setting(), so that both explain nodes the same way
+
+        @return: A new DatabaseSession
+        """
+        session = DatabaseSession(self.login_details, self.databasename)
+        for name, value in self._changed_settings.items():
+            session.set_setting(name, value)
+        if not self._changed_settings:
+            session._settings = self.settings
+        return session
+
+    def close(self):
+        """
+        Return the connection to the pool. The session can be reused afterwards
+        """
+        if self.cursor is not None:
+            # Settings outlive the transaction, do not leak them to the next borrower
+            if self._changed_settings:
+                self.cursor.execute("RESET ALL")
+                self._changed_settings = {}
+            self._settings = None
+            self.cursor.close()
+            self.pool.putconn(self.connection)
+            self.connection = None
+            self.cursor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class StatsCache(object):
+    """
+    Thread-safe LRU cache of relation statistics with a time-to-live
+
+    Entries are keyed by (kind, database, relation[, attribute]) where kind
+    names the statistic, e.g. "blocks" or "tuples". The database part
+    identifies the server as well so that two servers with a database of
+    the same name do not share entries.
+
+    @param max_entries: Maximum number of entries kept before the least recently used is evicted
+    @param ttl: Seconds an entry stays valid
+    @param dependents: Caches of values computed from the entries of this
+                       one, which invalidate() invalidates as well
+    """
+
+    def __init__(self, max_entries=4096, ttl=600, dependents=()):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.dependents = dependents
+
+        # key -> (value, time it was stored)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        @return: The cached value for key, or None if it is missing or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[1] <= self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_load(self, key, loader):
+        """
+        Return the cached value for key, calling loader() to compute and
+        store it on a miss. Nothing is stored if loader() raises.
+        """
+        value = self.get(key)
+        if value is None:
+            value = loader()
+            self.put(key, value)
+        return value
+
+    def invalidate(self, database=None, relation=None):
+        """
+        Drop cached entries. With no arguments the whole cache is cleared.
+        The dependents are not keyed by relation, they drop every entry of
+        the database instead
+
+        @param database: Only drop entries of this database (as built by stats_database())
+        @param relation: Only drop entries of this relation
+        """
+        with self._lock:
+            if database is None and relation is None:
+                self._entries.clear()
+            else:
+                for key in list(self._entries):
+                    if database is not None and key[1] != database:
+                        continue
+                    if relation is not None and (len(key) < 3 or key[2] != relation):
+                        continue
+                    del self._entries[key]
+
+        for cache in self.dependents:
+            cache.invalidate(database)
+
+    def snapshot(self):
+        """
+        @return: A dict of every entry that has not expired, key -> value.
+                 Used to share the cache with other processes
+        """
+        now = time.monotonic()
+        with self._lock:
+            return {
+                key: value
+                for key, (value, stored) in self._entries.items()
+                if now - stored <= self.ttl
+            }
+
+    def update(self, entries):
+        """
+        Add the entries of another cache's snapshot() that are missing from
+        this one. They count as fresh, the times of another process do not compare
+
+        @param entries: A dict of key -> value
+        """
+        for key, value in entries.items():
+            with self._lock:
+                if key in self._entries:
+                    continue
+            self.put(key, value)
+
+    @property
+    def hit_rate(self):
+        requests = self.hits + self.misses
+        return self.hits / requests if requests else 0.0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hit_rate,
+                "evictions": self.evictions,
+            }
+
+
+# Relation statistics shared by every explanation in this process. Also keeps
+# the settings snapshot of every database and which (relation, attribute)
+# pairs were prefetched, see Tree.prefetch_stats()
+stats_cache = StatsCache()
+
+# The explanations below quote the statistics of stats_cache. They expire
+# after the same time, and stats_cache.invalidate() drops them as well
+
+# Explanations and parent_dicts of plan subtrees, keyed by
+# ("subtree", database, subtree hash, exact_counts, options, settings snapshot)
+subtree_cache = StatsCache(max_entries=8192, ttl=stats_cache.ttl)
+
+# Estimates of nodes of the same shape in plans that only differ in the
+# literals of the query, keyed by
+# ("shape", database, shape hash, exact_counts, options, settings snapshot)
+explanation_cache = StatsCache(max_entries=8192, ttl=stats_cache.ttl)
+
+stats_cache.dependents = (subtree_cache, explanation_cache)
+
+
+def stats_database(login_details: LoginDetails, databasename):
+    """
+    @return: The database part of a stats_cache key
+    """
+    return (login_details.host, str(login_details.port), databasename)
+
+
+# Planner settings referred to by the node explanations
+COST_SETTINGS = (
+    "block_size",
+    "shared_buffers",
+    "work_mem",
+    "hash_mem_multiplier",
+    "effective_cache_size",
+    "seq_page_cost",
+    "random_page_cost",
+    "cpu_tuple_cost",
+    "cpu_index_tuple_cost",
+    "cpu_operator_cost",
+    "parallel_setup_cost",
+    "parallel_tuple_cost",
+    "max_parallel_workers_per_gather",
+)
+
+SETTINGS_QUERY = """
+SELECT name, setting, unit, vartype FROM pg_settings WHERE name IN ({names})
+""".format(
+    names=", ".join("'" + name + "'" for name in COST_SETTINGS)
+)
+
+
+def parse_settings(rows):
+    """
+    Convert rows of (name, setting, unit, vartype) from pg_settings into a
+    dict of name -> value, with numeric settings converted to numbers.
+    Memory settings stay in their native unit, e.g. 8kB pages for shared_buffers,
+    which is stored under name + "_unit".
+    """
+    settings = {}
+    for name, setting, unit, vartype in rows or []:
+        if vartype == "integer":
+            settings[name] = int(setting)
+        elif vartype == "real":
+            settings[name] = float(setting)
+        else:
+            settings[name] = setting
+        if unit:
+            settings[name + "_unit"] = unit
+    return settings
+
+
+def quote_literal(value: str) -> str:
+    """
+    Quote a string as an SQL literal
+    """
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def tuples_from_catalog(reltuples, relpages, num_blocks, n_live_tup):
+    """
+    Estimate the number of tuples of a relation the same way the planner does:
+    the tuple density recorded by the last ANALYZE or VACUUM, scaled to the
+    current number of blocks.
+
+    @return: A tuple of (number of tuples, description of where it came from)
+    """
+    if reltuples is not None and reltuples >= 0 and relpages:
+        return (
+            round(reltuples / relpages * num_blocks),
+            "estimated from pg_class.reltuples",
+        )
+    if n_live_tup:
+        return n_live_tup, "estimated from pg_stat_user_tables.n_live_tup"
+    if reltuples is not None and reltuples >= 0:
+        return round(reltuples), "estimated from pg_class.reltuples"
+    return 0, "no statistics, relation has never been analyzed"
+
+
+# Tuples per block assumed for a relation without statistics, rows of about
+# 70 bytes. Wider rows make the sample smaller, never larger than the cap
+ASSUMED_TUPLES_PER_BLOCK = 100
+
+# Largest share of a relation sample_distinct() reads, unless the whole
+# relation holds fewer tuples than the sample would
+MAX_SAMPLE_PERCENT = 10.0
+
+
+def sample_percent(num_blocks, num_tuples, sample_rows):
+    """
+    Choose the share of blocks to sample to read about sample_rows tuples.
+    The number of blocks from pg_relation_size is exact, the number of
+    tuples is only an estimate and is 0 for a relation never analyzed,
+    so the number of tuples per block is estimated instead.
+
+    @param num_blocks: The number of blocks of the relation, see Node.B()
+    @param num_tuples: The estimated number of tuples, 0 if unknown
+    @param sample_rows: Approximate number of tuples to sample
+    @return: A percentage for TABLESAMPLE SYSTEM. 100.0 for a relation
+             smaller than the sample, at most MAX_SAMPLE_PERCENT otherwise
+    """
+    if not num_blocks:
+        return 100.0
+    tuples_per_block = num_tuples / num_blocks if num_tuples else ASSUMED_TUPLES_PER_BLOCK
+    percent = 100.0 * sample_rows / (tuples_per_block * num_blocks)
+    if percent >= 100.0:
+        return 100.0
+    return min(percent, MAX_SAMPLE_PERCENT)
+
+
+def distinct_from_catalog(n_distinct, num_tuples):
+    """
+    Resolve pg_stats.n_distinct, where a negative value is the
+    negated fraction of the number of tuples
+
+    @return: A tuple of (number of unique values, description of where it came from)
+    """
+    if n_distinct < 0:
+        n_distinct = -n_distinct * num_tuples
+    return round(n_distinct), "estimated from pg_stats.n_distinct"
+
+
+def check_connection(login_details: LoginDetails, databasename=None):
+    """
+    Attempts to connect to a PostgreSQL database and returns True if successful.
+
+    :param login_details: An instance of LoginDetails containing connection parameters.
+    :param databasename: Optional. The name of the database to connect to.
+    :return: True if the connection is successful, False otherwise.
+    """
+    try:
+        # Connect to the database (or just the server if databasename is None)
+        conn = psycopg2.connect(
+            host=login_details.host,
+            port=login_details.port,
+            user=login_details.user,
+            password=login_details.password,
+            dbname=databasename if databasename else "",
+        )
+
+        # If the connection was successful, close it and return True
+        print("Login Successful")
+        conn.close()
+        return True
+    except psycopg2.OperationalError as e:
+        from project import Main
+
+        Main.show_error("Connection to DB Failed\n" + str(e))
+        return False
+
+
+def get_database_names(login_details: LoginDetails) -> List[str]:
+    try:
+        with DatabaseConnector(login_details) as cursor:
+            query = "SELECT datname FROM pg_database WHERE datistemplate = false;"
+            cursor.execute(query)
+            database_list = cursor.fetchall()
+            database_list = [i[0] for i in database_list]
+            return database_list
+    except psycopg2.OperationalError as e:
+        from project import Main
+
+        Main.show_error(str(e))
+
+
+async def check_connection_async(login_details: LoginDetails, databasename=None):
+    """
+    Asynchronous counterpart of check_connection(). Connect to a PostgreSQL
+    database, or just the server, and disconnect
+
+    @param login_details: User-provided login details to the UI
+    @param databasename: Optional. The name of the database to connect to
+    @return: True
+    @raise psycopg2.OperationalError: If the connection failed
+    """
+    async with AsyncSession(login_details, databasename) as session:
+        await session.connect()
+    return True
+
+
+async def get_database_names_async(login_details: LoginDetails) -> List[str]:
+    """
+    Asynchronous counterpart of get_database_names()
+
+    @return: The names of the databases on the server, templates excluded
+    @raise psycopg2.OperationalError: If the connection failed
+    """
+    async with AsyncSession(login_details) as session:
+        rows = await session.run("SELECT datname FROM pg_database WHERE datistemplate = false;")
+    return [row[0] for row in rows]
+
+
+class QueryCancelled(Exception):
+    """
+    Raised by retrieve_query when the query was cancelled through its
+    QueryHandle or exceeded its statement timeout
+
+    @param timed_out: True if the statement timeout expired, False if cancelled
+    """
+
+    def __init__(self, message, timed_out=False):
+        super().__init__(message)
+        self.timed_out = timed_out
+
+
+class QueryHandle(object):
+    """
+    Handle on an in-flight retrieve_query call, used to cancel it from
+    another thread. Cancelling sends a cancel request to the server for the
+    connection the query is running on. A handle cancelled before its query
+    starts makes the query fail immediately.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connection = None
+        self.cancelled = False
+
+    def attach(self, connection):
+        """
+        Register the connection the query is about to run on
+        """
+        with self._lock:
+            self.check()
+            self._connection = connection
+
+    def detach(self):
+        """
+        Forget the connection once the query finished, so that a late cancel
+        does not interrupt whoever borrows the connection next
+        """
+        with self._lock:
+            self._connection = None
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            if self._connection is not None:
+                self._connection.cancel()
+
+    def check(self):
+        """
+        Raise QueryCancelled if the handle was cancelled
+        """
+        if self.cancelled:
+            raise QueryCancelled("Query was cancelled")
+
+
+def retrieve_query(
+    login_details: LoginDetails,
+    querydetails: QueryDetails,
+    explain=True,
+    statement_timeout=None,
+    handle: QueryHandle = None,
+    options: ExplainOptions = EXPLAIN_ANALYZE,
+):
+    """
+    Run the user query, by default wrapped in EXPLAIN ANALYZE
+
+    @param login_details: User-provided login details to the UI
+    @param querydetails: Contains the user-selected database and user-input query
+    @param explain: Whether to wrap the query in EXPLAIN
+    @param options: The ExplainOptions of the EXPLAIN statement
+    @param statement_timeout: Milliseconds after which the server aborts the query. None for no limit
+    @param handle: Optional QueryHandle used to cancel the query from another thread
+    @return: All rows of the result, or None if the query failed
+    @raise QueryCancelled: If the query was cancelled or timed out
+    """
+    with DatabaseConnector(login_details, querydetails.database) as cursor:
+        if explain:
+            query = f"{options.to_sql()} {str(querydetails.query)}"
+        else:
+            query = str(querydetails.query)
+
+        try:
+            # Only lasts until the end of the transaction, which ends when
+            # the connection is returned to the pool
+            if statement_timeout:
+                cursor.execute(
+                    "SELECT set_config('statement_timeout', %s, true)",
+                    (str(int(statement_timeout)),),
+                )
+
+            if handle is not None:
+                handle.attach(cursor.connection)
+            try:
+                print(querydetails.query.strip())
+                cursor.execute(query)
+                query_data = cursor.fetchall()
+            finally:
+                if handle is not None:
+                    handle.detach()
+            print(query_data)
+            return query_data
+        except psycopg2.extensions.QueryCanceledError:
+            if handle is not None and handle.cancelled:
+                raise QueryCancelled("Query was cancelled")
+            raise QueryCancelled(
+                "Query exceeded the statement timeout of "
+                + str(statement_timeout)
+                + " ms",
+                timed_out=True,
+            )
+        except psycopg2.Error:
+            return None
+
+
+def normalize_query(query: str) -> str:
+    """
+    Normalize SQL text so that formatting differences map to the same plan
+    cache entry: comments are removed, whitespace is collapsed, unquoted text
+    is lower-cased and trailing semicolons are dropped. String literals,
+    quoted identifiers and dollar-quoted strings are kept verbatim.
+
+    Where a literal cannot be delimited with certainty, e.g. a backslash in a
+    plain string, whose meaning depends on standard_conforming_strings, or an
+    unterminated quote, the query is returned unchanged: two different
+    queries must never share a plan cache entry.
+    """
+    out = []
+    i = 0
+    n = len(query)
+    pending_space = False
+    while i < n:
+        c = query[i]
+
+        # Comments and whitespace only separate tokens
+        if query.startswith("--", i):
+            end = query.find("\n", i)
+            i = n if end == -1 else end
+            pending_space = True
+            continue
+        if query.startswith("/*", i):
+            end = query.find("*/", i + 2)
+            i = n if end == -1 else end + 2
+            pending_space = True
+            continue
+        if c.isspace():
+            i += 1
+            pending_space = True
+            continue
+
+        if pending_space and out:
+            out.append(" ")
+        pending_space = False
+
+        # The previous character, to tell prefixes and $ apart from identifier characters
+        previous = out[-1][-1] if out else ""
+        in_identifier = previous.isalnum() or previous in "_$"
+
+        if c in "eE" and query.startswith("'", i + 1) and not in_identifier:
+            # Escape string, e.g. E'it\'s', a backslash escapes the next character
+            end = i + 2
+            while end < n:
+                if query[end] == "\\":
+                    end += 2
+                    continue
+                if query[end] == "'":
+                    if end + 1 < n and query[end + 1] == "'":
+                        end += 2
+                        continue
+                    break
+                end += 1
+            if end >= n:
+                return query
+            out.append("e" + query[i + 1 : end + 1])
+            i = end + 1
+        elif c == "'" or c == '"':
+            # Quoted string or identifier, a doubled quote is an escaped quote
+            end = i + 1
+            while end < n:
+                if query[end] == c:
+                    if end + 1 < n and query[end + 1] == c:
+                        end += 2
+                        continue
+                    break
+                end += 1
+            if end >= n or (c == "'" and "\\" in query[i:end]):
+                return query
+            out.append(query[i : end + 1])
+            i = end + 1
+        elif c == "$" and not in_identifier and query.find("$", i + 1) != -1:
+            # Dollar-quoted string, e.g. $tag$ ... $tag$. Not a parameter such as $1
+            tag_end = query.find("$", i + 1)
+            tag = query[i : tag_end + 1]
+            body = tag[1:-1]
+            if tag == "$$" or (body.replace("_", "").isalnum() and not body[0].isdigit()):
+                end = query.find(tag, tag_end + 1)
+                end = n if end == -1 else end + len(tag)
+                out.append(query[i:end])
+                i = end
+            else:
+                out.append(c)
+                i += 1
+        else:
+            out.append(c.lower())
+            i += 1
+
+    return "".join(out).rstrip("; ")
+
+
+class PlanCache(object):
+    """
+    Cache of EXPLAIN results, so that re-running the same query does not
+    execute it again
+
+    Entries are keyed by the database, the normalized SQL text, the
+    ExplainOptions and the planner settings snapshot, since each of them
+    changes the plan. Entries older than max_age are ignored and the least
+    recently used entries are evicted beyond max_entries.
+
+    @param path: Optional. JSON file the cache is loaded from and saved to,
+                 so that it survives restarts. Call save() before exiting.
+                 The json module recurses once per level of nesting, plans
+                 nested deeper than the recursion limit allows, about 500
+                 nodes deep by default, are only kept in memory
+    @param max_entries: Maximum number of cached results
+    @param max_age: Seconds a cached result stays valid
+    @param save_interval: put() writes the file at most once per this many seconds
+    """
+
+    def __init__(self, path=None, max_entries=256, max_age=3600, save_interval=30):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.save_interval = save_interval
+
+        # key -> (query_data, time.time() when it was stored)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Only one thread writes the file at a time. time.monotonic() of the last save
+        self._save_lock = threading.Lock()
+        self._saved_at = None
+
+        self.hits = 0
+        self.misses = 0
+
+        if path is not None:
+            self.load()
+
+    @staticmethod
+    def make_key(login_details, querydetails, options, settings):
+        """
+        @return: A string key, so that it can be persisted as JSON
+        """
+        return json.dumps(
+            [
+                list(stats_database(login_details, querydetails.database)),
+                normalize_query(str(querydetails.query)),
+                asdict(options),
+                sorted(settings.items()),
+            ]
+        )
+
+    def get(self, key):
+        """
+        @return: A tuple of (query_data, time it was stored), or None on a miss
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[1] <= self.max_age:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, query_data):
+        with self._lock:
+            self._entries[key] = (query_data, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            save_due = self._saved_at is None or time.monotonic() - self._saved_at >= self.save_interval
+        if self.path is not None and save_due:
+            self.save()
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+        if self.path is not None:
+            self.save()
+
+    def load(self):
+        """
+        Load the entries saved at self.path, skipping those already too old.
+        A file that is missing or was not written by save() is ignored as a whole
+        """
+        now = time.time()
+        loaded = []
+        try:
+            with open(self.path) as file:
+                entries = json.load(file)
+            for key, query_data, stored_at in entries:
+                if (
+                    not isinstance(key, str)
+                    or not isinstance(query_data, list)
+                    or not isinstance(stored_at, (int, float))
+                ):
+                    raise ValueError("Not a plan cache entry: " + repr(key))
+                if now - stored_at <= self.max_age:
+                    loaded.append((key, (query_data, stored_at)))
+        except (OSError, ValueError, TypeError, RecursionError):
+            return
+        with self._lock:
+            self._entries.update(loaded)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def save(self):
+        """
+        Write the entries to self.path. A temporary file is renamed over the
+        old one so that a crash never leaves a truncated cache behind.
+        Entries too deeply nested for the json module are left out
+        """
+        with self._save_lock:
+            with self._lock:
+                entries = [
+                    [key, query_data, stored_at]
+                    for key, (query_data, stored_at) in self._entries.items()
+                ]
+                self._saved_at = time.monotonic()
+
+            encoded = []
+            for entry in entries:
+                try:
+                    encoded.append(json.dumps(entry))
+                except RecursionError:
+                    continue
+
+            # A unique temporary file, in the same directory so that the rename is atomic
+            fd, temp_path = tempfile.mkstemp(
+                prefix=os.path.basename(self.path) + ".",
+                suffix=".tmp",
+                dir=os.path.dirname(os.path.abspath(self.path)),
+            )
+            try:
+                with os.fdopen(fd, "w") as file:
+                    file.write("[" + ", ".join(encoded) + "]")
+                os.replace(temp_path, self.path)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+# EXPLAIN results shared by every explanation in this process
+plan_cache = PlanCache()
+
+
+def retrieve_plan(
+    login_details: LoginDetails,
+    querydetails: QueryDetails,
+    options: ExplainOptions = EXPLAIN_ANALYZE,
+    statement_timeout=None,
+    handle: QueryHandle = None,
+    refresh=False,
+    cache: PlanCache = None,
+    prefetch=True,
+):
+    """
+    retrieve_query through the plan cache
+
+    @param refresh: Run the query even if a cached result exists, and replace it
+    @param cache: The PlanCache to use. Defaults to the shared plan_cache
+    @param prefetch: While EXPLAIN ANALYZE executes the query, prefetch the
+                     statistics of its relations on a second connection with
+                     prefetch_query_stats(), so that they are in stats_cache
+                     by the time the plan is returned
+    @return: A tuple of (query_data, time.time() the result was cached). The
+             time is None if the query was just run
+    @raise QueryCancelled: If the query was cancelled or timed out
+    """
+    cache = plan_cache if cache is None else cache
+
+    # The planner settings are part of the key, a changed setting can change the plan
+    with DatabaseSession(login_details, querydetails.database) as session:
+        key = cache.make_key(login_details, querydetails, options, session.settings)
+
+    if not refresh:
+        entry = cache.get(key)
+        if entry is not None:
+            return entry
+
+    # Without ANALYZE the plan comes back as fast as a prefetch would
+    prefetcher = None
+    if prefetch and options.analyze:
+        prefetcher = threading.Thread(
+            target=prefetch_query_stats, args=(login_details, querydetails), daemon=True
+        )
+        prefetcher.start()
+
+    try:
+        query_data = retrieve_query(
+            login_details,
+            querydetails,
+            statement_timeout=statement_timeout,
+            handle=handle,
+            options=options,
+        )
+    finally:
+        if prefetcher is not None:
+            prefetcher.join()
+    if query_data:
+        cache.put(key, query_data)
+    return query_data, None
+
+
+def prefetch_query_stats(login_details: LoginDetails, querydetails: QueryDetails):
+    """
+    Plan the query with a plain EXPLAIN, which does not execute it, and
+    prefetch the statistics of every relation in that plan into stats_cache,
+    see Tree.prefetch_stats(). The plan explained later has the same
+    relations, so its own prefetch finds them and does not query again.
+
+    Only an optimization, on any error the statistics are fetched later as usual.
+    """
+    try:
+        with Tree(login_details, querydetails, options=ESTIMATE_ONLY) as tree:
+            rows = tree.session.execute(f"{ESTIMATE_ONLY.to_sql()} {querydetails.query}")
+            if not rows:
+                return
+            tree.build_tree(rows[0][0][0]["Plan"])
+            tree.prefetch_stats()
+    except Exception as e:
+        print("Statistics prefetch failed: " + str(e))
+
+
+#################### ASYNCHRONOUS API ######################
+
+# Maximum number of explanations that run at the same time on one event loop
+ASYNC_MAX_CONCURRENCY = 8
+
+_limiters = weakref.WeakKeyDictionary()
+_limiters_lock = threading.Lock()
+
+
+def async_limiter() -> asyncio.Semaphore:
+    """
+    @return: The semaphore that bounds the explanations running on the
+             current event loop to ASYNC_MAX_CONCURRENCY. Every event loop
+             has its own, a semaphore cannot be shared between loops
+    """
+    loop = asyncio.get_running_loop()
+    with _limiters_lock:
+        limiter = _limiters.get(loop)
+        if limiter is None:
+            limiter = _limiters[loop] = asyncio.Semaphore(ASYNC_MAX_CONCURRENCY)
+        return limiter
+
+
+async def wait_async(connection):
+    """
+    Wait until an asynchronous psycopg2 connection has finished its current
+    operation, e.g. connecting or executing a query, without blocking the
+    event loop. The loop is told when the connection's socket is ready.
+
+    Event loops that cannot watch sockets, like the default one on Windows,
+    wait on a separate thread instead.
+
+    @param connection: A connection opened with async_=True
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        state = connection.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+        if state == psycopg2.extensions.POLL_READ:
+            add, remove = loop.add_reader, loop.remove_reader
+        elif state == psycopg2.extensions.POLL_WRITE:
+            add, remove = loop.add_writer, loop.remove_writer
+        else:
+            raise psycopg2.OperationalError("Unexpected result from poll(): " + str(state))
+
+        ready = loop.create_future()
+        fileno = connection.fileno()
+        try:
+            add(fileno, lambda: ready.done() or ready.set_result(None))
+        except NotImplementedError:
+            await asyncio.to_thread(psycopg2.extras.wait_select, connection)
+            return
+        try:
+            await ready
+        finally:
+            remove(fileno)
+
+
+class AsyncSession(object):
+    """
+    Asynchronous counterpart of DatabaseSession, on a psycopg2 connection in
+    asynchronous mode. The connection is opened on first use and closed by
+    close(). Asynchronous connections cannot be pooled and always run in
+    autocommit mode, so settings last until the session is closed.
+
+    If the task awaiting a query is cancelled, the query is cancelled on the
+    server as well.
+
+    @param login_details: User-provided login details to the UI
+    @param databasename: The database that the queries run against
+    """
+
+    def __init__(self, login_details: LoginDetails, databasename=None):
+        self.login_details = login_details
+        self.databasename = databasename
+        self.connection = None
+        self.cursor = None
+
+        # Number of queries executed on this session
+        self.queries = 0
+
+        # Snapshot of COST_SETTINGS, loaded on first use
+        self._settings = None
+
+    async def connect(self):
+        """
+        Open the connection if it is not open yet
+
+        @raise psycopg2.OperationalError: If the connection failed
+        """
+        if self.connection is not None:
+            return
+        connection = psycopg2.connect(
+            host=self.login_details.host,
+            port=self.login_details.port,
+            user=self.login_details.user,
+            password=self.login_details.password,
+            dbname=self.databasename if self.databasename else "",
+            async_=True,
+        )
+        try:
+            await wait_async(connection)
+        except BaseException:
+            connection.close()
+            raise
+        self.connection = connection
+        self.cursor = connection.cursor()
+
+    async def run(self, query, params=None):
+        """
+        Execute a query and return all rows of the result
+
+        @param query: The SQL string to execute
+        @param params: Optional parameters of the query
+        @raise psycopg2.Error: If the query failed
+        """
+        await self.connect()
+        self.queries += 1
+        connection = self.connection
+        self.cursor.execute(query, params)
+        try:
+            await wait_async(connection)
+        except asyncio.CancelledError:
+            # Do not leave the query running on the server. Closing the
+            # session in the meantime already ended it
+            if connection is self.connection:
+                connection.cancel()
+            raise
+        return self.cursor.fetchall()
+
+    async def execute(self, query, params=None):
+        """
+        Execute a query like DatabaseSession.execute()
+
+        @return: All rows of the result, or None if the query failed
+        """
+        try:
+            return await self.run(query, params)
+        except psycopg2.Error:
+            return None
 
+    async def settings(self):
+        """
+        Snapshot of the planner settings in COST_SETTINGS, read in one query
+        the first time it is needed and kept for the rest of the session
+        """
+        if self._settings is None:
+            self._settings = parse_settings(await self.execute(SETTINGS_QUERY))
+        return self._settings
 
-class DatabaseConnector(object):
-    def __init__(self, login_details: LoginDetails, databasename=None):
-        self.connector = psycopg2.connect(
-            host=login_details.host,
-            port=login_details.port,
-            user=login_details.user,
-            password=login_details.password,
-            dbname=databasename if databasename else "",
-        ).cursor()
+    async def close(self):
+        """
+        Close the connection. The session can be reused afterwards
+        """
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+            self.cursor = None
+        self._settings = None
 
-    def __enter__(self):
-        return self.connector
+    async def __aenter__(self):
+        return self
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.connector.close()
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
 
 
-def check_connection(login_details: LoginDetails, databasename=None):
+class BlockingSession(object):
     """
-    Attempts to connect to a PostgreSQL database and returns True if successful.
+    A DatabaseSession for a Tree explained on a thread, whose queries run on
+    an AsyncSession of the event loop instead of a pooled connection. The
+    thread waits for each result, the event loop does not.
 
-    :param login_details: An instance of LoginDetails containing connection parameters.
-    :param databasename: Optional. The name of the database to connect to.
-    :return: True if the connection is successful, False otherwise.
+    It cannot be forked, explain the tree with max_workers=1.
+
+    @param session: The AsyncSession to run the queries on. Its owner closes it
+    @param loop: The event loop of session
     """
-    try:
-        # Connect to the database (or just the server if databasename is None)
-        conn = psycopg2.connect(
-            host=login_details.host,
-            port=login_details.port,
-            user=login_details.user,
-            password=login_details.password,
-            dbname=databasename if databasename else "",
-        )
 
-        # If the connection was successful, close it and return True
-        print("Login Successful")
-        conn.close()
-        return True
-    except psycopg2.OperationalError as e:
-        from project import Main
+    def __init__(self, session: AsyncSession, loop):
+        self.session = session
+        self.loop = loop
 
-        Main.show_error("Connection to DB Failed\n" + str(e))
-        return False
+        # Set on the loop by detach(), queries return None afterwards
+        self.detached = False
 
+        # Tasks of the queries running on the loop
+        self._tasks = set()
+
+    def _wait(self, method, *args):
+        """
+        Run a coroutine method of the AsyncSession on the loop and wait for its result
+        """
+        return asyncio.run_coroutine_threadsafe(self._call(method, *args), self.loop).result()
+
+    async def _call(self, method, *args):
+        # Checked on the loop, so that a closed session is never reopened
+        if self.detached:
+            return None
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            return await method(*args)
+        finally:
+            self._tasks.discard(task)
+
+    def detach(self):
+        """
+        Stop using the AsyncSession, e.g. before it is closed, and cancel the
+        running query. Call it on the loop
+        """
+        self.detached = True
+        for task in self._tasks:
+            task.cancel()
+
+    @property
+    def queries(self):
+        return self.session.queries
+
+    def execute(self, query):
+        """
+        @return: All rows of the result, or None if the query failed
+        """
+        return self._wait(self.session.execute, query)
+
+    @property
+    def settings(self):
+        # Only the first read needs the loop
+        if self.session._settings is not None:
+            return self.session._settings
+        return self._wait(self.session.settings) or {}
+
+    def seed_settings(self, rows):
+        self.session._settings = parse_settings(rows)
+
+    def close(self):
+        # The AsyncSession belongs to the caller
+        pass
+
+
+async def retrieve_query_async(
+    login_details: LoginDetails,
+    querydetails: QueryDetails,
+    explain=True,
+    statement_timeout=None,
+    options: ExplainOptions = EXPLAIN_ANALYZE,
+    session: AsyncSession = None,
+):
+    """
+    Asynchronous counterpart of retrieve_query. Cancel the awaiting task to
+    cancel the query, there is no QueryHandle
+
+    @param session: Optional. The AsyncSession to run the query on, which is
+                    left open. By default a session is opened for the query
+    @return: All rows of the result, or None if the query failed
+    @raise QueryCancelled: If the query exceeded the statement timeout
+    """
+    own_session = session is None
+    if own_session:
+        session = AsyncSession(login_details, querydetails.database)
+
+    if explain:
+        query = f"{options.to_sql()} {str(querydetails.query)}"
+    else:
+        query = str(querydetails.query)
 
-def get_database_names(login_details: LoginDetails) -> List[str]:
     try:
-        with DatabaseConnector(login_details) as cursor:
-            query = "SELECT datname FROM pg_database WHERE datistemplate = false;"
-            cursor.execute(query)
-            database_list = cursor.fetchall()
-            database_list = [i[0] for i in database_list]
-            return database_list
-    except psycopg2.OperationalError as e:
-        from project import Main
+        timed_out = False
+        try:
+            if statement_timeout:
+                await session.run(
+                    "SELECT set_config('statement_timeout', %s, false)",
+                    (str(int(statement_timeout)),),
+                )
+            rows = await session.run(query)
+        except psycopg2.extensions.QueryCanceledError:
+            timed_out = True
+        except psycopg2.Error:
+            rows = None
+
+        # The caller's session runs more queries, they must not time out
+        if statement_timeout and not own_session:
+            await session.execute("RESET statement_timeout")
+
+        if timed_out:
+            raise QueryCancelled(
+                "Query exceeded the statement timeout of "
+                + str(statement_timeout)
+                + " ms",
+                timed_out=True,
+            )
+        return rows
+    finally:
+        if own_session:
+            await session.close()
 
-        Main.show_error(str(e))
 
+async def prefetch_stats_async(tree, session: AsyncSession):
+    """
+    Asynchronous counterpart of Tree.prefetch_stats(), the catalog query
+    runs on session instead of the tree's own
 
-def retrieve_query(
-    login_details: LoginDetails, querydetails: QueryDetails, explain=True
+    @param tree: A Tree whose nodes are built
+    @param session: The AsyncSession to query
+    """
+    prefetch = tree.stats_prefetch_query()
+    if prefetch is not None:
+        requests, query = prefetch
+        tree.seed_stats(requests, await session.execute(query))
+
+
+async def prefetch_query_stats_async(login_details: LoginDetails, querydetails: QueryDetails):
+    """
+    Asynchronous counterpart of prefetch_query_stats()
+    """
+    try:
+        async with AsyncSession(login_details, querydetails.database) as session:
+            rows = await session.execute(f"{ESTIMATE_ONLY.to_sql()} {querydetails.query}")
+            if not rows:
+                return
+            tree = Tree(login_details, querydetails, options=ESTIMATE_ONLY)
+            tree.build_tree(rows[0][0][0]["Plan"])
+            await prefetch_stats_async(tree, session)
+    except Exception as e:
+        print("Statistics prefetch failed: " + str(e))
+
+
+async def explain_async(
+    login_details: LoginDetails,
+    sql: str,
+    database: str,
+    options: ExplainOptions = EXPLAIN_ANALYZE,
+    statement_timeout=None,
+    exact_counts=False,
+    refresh=False,
 ):
-    with DatabaseConnector(login_details, querydetails.database) as cursor:
-        if explain:
-            query = f"EXPLAIN (ANALYZE, VERBOSE, FORMAT JSON) {str(querydetails.query)}"
+    """
+    Run EXPLAIN on a query and explain every node of its plan, like the
+    interface does, without blocking the event loop. At most
+    ASYNC_MAX_CONCURRENCY explanations run at the same time on one loop.
+
+    The settings, the query and the catalog queries of the nodes share one
+    asynchronous connection. With ANALYZE, the statistics are prefetched on
+    a second one while the query executes. The plan goes through plan_cache
+    like retrieve_plan(). Building the explanation text is CPU work and runs
+    on a thread, its catalog queries run on the event loop through a
+    BlockingSession.
+
+    @param login_details: User-provided login details to the UI
+    @param sql: The query to explain
+    @param database: The database to run it on
+    @param options: The ExplainOptions of the EXPLAIN statement
+    @param statement_timeout: Milliseconds after which the server aborts the query. None for no limit
+    @param exact_counts: Count tuples by scanning the relations, see Tree
+    @param refresh: Run the query even if a cached plan exists, and replace it
+    @return: The explanation of the whole plan, or None if the query failed
+    @raise QueryCancelled: If the query exceeded the statement timeout
+    """
+    query_details = QueryDetails(database=database, query=sql)
+    async with async_limiter(), AsyncSession(login_details, database) as session:
+        settings = await session.settings()
+        key = plan_cache.make_key(login_details, query_details, options, settings)
+
+        entry = None if refresh else plan_cache.get(key)
+        if entry is not None:
+            query_data, cached_at = entry
         else:
-            query = str(querydetails.query)
+            cached_at = None
+            retrieval = retrieve_query_async(
+                login_details,
+                query_details,
+                statement_timeout=statement_timeout,
+                options=options,
+                session=session,
+            )
+            if options.analyze:
+                query_data, _ = await asyncio.gather(
+                    retrieval, prefetch_query_stats_async(login_details, query_details)
+                )
+            else:
+                query_data = await retrieval
+            if not query_data:
+                return None
+            await asyncio.to_thread(plan_cache.put, key, query_data)
+
+        blocking_session = BlockingSession(session, asyncio.get_running_loop())
+
+        def explain_plan():
+            summary = dict(query_data[0][0][0])
+            if cached_at is not None:
+                summary["Cached At"] = cached_at
+            tree = initialize_tree(
+                query_data[0][0][0]["Plan"],
+                login_details,
+                query_details,
+                exact_counts,
+                options,
+                summary,
+                session=blocking_session,
+            )
+            return load_qep_explanations(tree)
 
         try:
-            print(querydetails.query.strip())
-            cursor.execute(query)
-            query_data = cursor.fetchall()
-            print(query_data)
-            return query_data
-        except:
-            return None
+            return await asyncio.to_thread(explain_plan)
+        finally:
+            # If this task is cancelled the thread runs on, without the session
+            blocking_session.detach()
 
 
-def load_qep_explanations(tree):
-    return tree.explain_all_nodes(tree.root).strip()
+async def explain_many_async(
+    login_details: LoginDetails,
+    requests,
+    options: ExplainOptions = EXPLAIN_ANALYZE,
+    statement_timeout=None,
+):
+    """
+    Explain many queries concurrently with explain_async(), bounded by
+    ASYNC_MAX_CONCURRENCY
+
+    @param requests: An iterable of (sql, database) pairs
+    @return: A list with the explanation of every request in order. A
+             request that raised has the exception in its place instead
+    """
+    return await asyncio.gather(
+        *(
+            explain_async(login_details, sql, database, options, statement_timeout)
+            for sql, database in requests
+        ),
+        return_exceptions=True,
+    )
+
+
+def describe_buffers(stats):
+    """
+    Describe the buffer counters and I/O timings of a plan node, or of the
+    planning phase, as reported by EXPLAIN (ANALYZE, BUFFERS)
+
+    @param stats: The node JSON, or the "Planning" entry of the EXPLAIN output
+    @return: A list of lines, empty if no buffer usage was reported
+    """
+    lines = []
+    for kind in ("Shared", "Local"):
+        if kind + " Hit Blocks" not in stats:
+            continue
+        counts = [
+            stats.get(kind + " " + name + " Blocks", 0)
+            for name in ("Hit", "Read", "Dirtied", "Written")
+        ]
+        # Local buffers are only used by temporary tables, skip them when unused
+        if kind == "Local" and not any(counts):
+            continue
+        lines.append(
+            "Buffers ("
+            + kind.lower()
+            + "): "
+            + str(counts[0])
+            + " hit, "
+            + str(counts[1])
+            + " read, "
+            + str(counts[2])
+            + " dirtied, "
+            + str(counts[3])
+            + " written"
+        )
+
+    if stats.get("Temp Read Blocks") or stats.get("Temp Written Blocks"):
+        lines.append(
+            "Buffers (temp): "
+            + str(stats.get("Temp Read Blocks", 0))
+            + " read, "
+            + str(stats.get("Temp Written Blocks", 0))
+            + " written"
+        )
+
+    # Only present with track_io_timing. PostgreSQL 16 and earlier
+    # report a single read and write time for all shared and local blocks
+    timings = []
+    for prefix in ("", "Shared ", "Local ", "Temp "):
+        for direction in ("Read", "Write"):
+            key = prefix + "I/O " + direction + " Time"
+            if stats.get(key):
+                timings.append(
+                    prefix.lower() + direction.lower() + " " + str(stats[key]) + " ms"
+                )
+    if timings:
+        lines.append("I/O Timings: " + ", ".join(timings))
+
+    return lines
+
+
+def stream_qep_explanations(tree):
+    """
+    Explain every node of the tree, yielding the output of each node as soon
+    as it is ready, followed by the query summary if there is one
+    """
+    # The tree's database session is no longer needed once every node is explained
+    with tree:
+        yield from tree.iter_explanations(tree.root)
 
+    # Planning, execution, trigger and JIT times of the whole query
+    summary = tree.explain_summary()
+    if summary:
+        yield "~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~\n\n" + summary
 
-def initialize_tree(plan_json, login_details, query_details):
-    tree = Tree(login_details, query_details)
+
+def load_qep_explanations(tree):
+    return "".join(stream_qep_explanations(tree)).strip()
+
+
+def initialize_tree(
+    plan_json,
+    login_details,
+    query_details,
+    exact_counts=False,
+    options: ExplainOptions = EXPLAIN_ANALYZE,
+    summary=None,
+    max_workers=1,
+    session=None,
+):
+    """
+    @param plan_json: The "Plan" entry of the EXPLAIN output
+    @param summary: Optional. The rest of the EXPLAIN output, e.g. "Planning Time",
+                    "Execution Time", "Triggers" and "JIT"
+    @param max_workers: Number of threads explaining independent subtrees, see Tree
+    @param session: Optional. The session of the catalog queries, see Tree
+    """
+    tree = Tree(
+        login_details, query_details, exact_counts, options, max_workers=max_workers, session=session
+    )
     tree.build_tree(plan_json)
+    if summary:
+        tree.summary = {key: value for key, value in summary.items() if key != "Plan"}
+
+    # Fetch the statistics of every relation in the plan in one round trip
+    tree.prefetch_stats()
 
     # Explain each node by DFS and return the output
     return tree
@@ -111,20 +1865,63 @@ class Tree(object):
     """
     Represents a Query Tree generated by PostgreSQL's JSON output
 
-    This tree is binary. If there is only one child, the child node will
-    be assigned to the left child.
+    Every node keeps all of its children. The first two are also available
+    as the left and right child, e.g. the outer and inner side of a join.
+
+    The tree owns one database session for its whole lifetime, which every
+    node uses for its catalog queries. Call close() or use the tree as a
+    context manager to return the connection to the pool.
 
     @param login_details: User-provided login details to the UI
     @param query_details: Contains the user-selected database and user-input query
+    @param exact_counts: Count tuples by scanning the relations instead of
+                         reading the planner statistics from the catalog
+    @param options: The ExplainOptions that produced the plan, which decide
+                    which measurements the nodes can explain
+    @param max_workers: Number of threads explaining independent subtrees at
+                        the same time, each with its own pooled connection.
+                        1 explains the nodes one by one on the tree's session
+    @param session: Optional. The session of the catalog queries, e.g. a
+                    BlockingSession. Defaults to a new DatabaseSession
     """
 
-    def __init__(self, login_details: LoginDetails, query_details: QueryDetails):
+    def __init__(
+        self,
+        login_details: LoginDetails,
+        query_details: QueryDetails,
+        exact_counts: bool = False,
+        options: ExplainOptions = EXPLAIN_ANALYZE,
+        max_workers: int = 1,
+        session=None,
+    ):
         # Root node of the tree
         self.root = None
 
         # Stores user-input details
         self.login_details = login_details
         self.query_details = query_details
+        self.exact_counts = exact_counts
+        self.options = options
+        self.max_workers = max_workers
+
+        # Database session shared by every node of this tree
+        if session is None:
+            session = DatabaseSession(login_details, query_details.database)
+        self.session = session
+
+        # The EXPLAIN output outside of the plan tree, e.g. "Execution Time"
+        self.summary = {}
+
+        # Number of nodes explained from scratch, reused from subtree_cache
+        # and shared through explanation_cache
+        self.nodes_recomputed = 0
+        self.nodes_reused = 0
+        self.nodes_shared = 0
+        self._counts_lock = threading.Lock()
+
+        # Outputs of the nodes explained by explain_node_lazily(), by node id
+        self.lazy_outputs = {}
+        self._post_order = None
 
         # The output string for the entire query tree that will be printed on the interface
         self.full_output = ""
@@ -135,85 +1932,590 @@ class Tree(object):
 
     def build_tree(self, node_json):
         """
-        Recursively build the binary tree from JSON data
+        Build the tree from JSON data
         Data given to build_tree is the value of the key "Plan"
 
         @param node_json: The JSON / dictionary of details specific to the node
         """
 
-        # Saves the root and begins recursively creating the tree
-        self.root = self._build_tree_recursive(node_json, count=[1])
+        # Saves the root and begins creating the tree
+        self.root = self._build_tree_iterative(node_json)
+
+        # Identify the subtrees that were already explained by a previous run
+        self.hash_subtrees()
 
-    def _build_tree_recursive(self, node_json, count=[1]):
+    def hash_subtrees(self):
         """
-        Helper function of self.Build_tree()
+        Hash every subtree from its nodes' plan fields, in post-order so that a
+        node's hash covers its children's. Two subtrees with the same hash have
+        the same estimates, explanation text and parent_dict, which
+        subtree_cache reuses. Measurements such as the actual times differ
+        between runs of the same plan and are not hashed, see Node.plan_fields()
+
+        The shape of every subtree is hashed in the same pass, see Node.shape()
+        and fingerprint()
+        """
+        nodes = list(self.iter_nodes())
+        for node in reversed(nodes):
+            digest = hashlib.sha1(
+                json.dumps(
+                    node.plan_fields(),
+                    sort_keys=True,
+                    default=str,
+                ).encode()
+            )
+            shape_digest = hashlib.sha1(node.shape().encode())
+            for child in node.children:
+                digest.update(child.subtree_hash)
+                shape_digest.update(child.shape_hash)
+            node.subtree_hash = digest.digest()
+            node.shape_hash = shape_digest.digest()
+
+    def fingerprint(self):
+        """
+        Plans of queries that only differ in literals or formatting have the
+        same fingerprint, see Node.shape()
 
-        Recursively build the binary tree from node data
+        @return: A hex digest of the shape of the whole plan
+        """
+        return self.root.shape_hash.hex()
 
-        @param node_json: The JSON / dictionary of details specific to the node
-        @param count: Mutable list which is by reference can maintain the state throughout mutable calls.
-        @return: The instantiated node
+    def subtree_key(self, node):
+        """
+        @return: The subtree_cache key of a node. Explanations also depend on
+                 the counting mode, the EXPLAIN options and the settings
         """
+        return (
+            "subtree",
+            stats_database(self.login_details, self.query_details.database),
+            node.subtree_hash,
+            self.exact_counts,
+            self.options,
+            tuple(sorted(self.session.settings.items())),
+        )
 
-        # Default case - Previous node is already a leaf node
-        if not node_json:
-            return None
+    def shape_key(self, node):
+        """
+        @return: The explanation_cache key of a node, like subtree_key() but
+                 with the hash of its shape instead of its plan
+        """
+        return (
+            "shape",
+            stats_database(self.login_details, self.query_details.database),
+            node.shape_hash,
+            self.exact_counts,
+            self.options,
+            tuple(sorted(self.session.settings.items())),
+        )
 
-        # Instantiate a Node subclass
-        node = self.instantiate_node(node_json)
+    def _build_tree_iterative(self, node_json):
+        """
+        Helper function of self.build_tree()
 
-        if node:
-            node.id = count[0]  # Assign the current count as the node number
-            count[0] += 1  # Increment the count for the next node
+        Build the tree from node data with an explicit stack, so that deeply
+        nested plans do not hit Python's recursion limit. Nodes are numbered
+        in pre-order, the parent before the subtrees of its children in order.
 
-        # Continue running this function only if there are child nodes
-        if node is not None and "Plans" in node.node_json:
-            plans = node.node_json["Plans"]
-            if len(plans) == 1:
-                node.left = self._build_tree_recursive(plans[0], count)
+        @param node_json: The JSON / dictionary of details specific to the root node
+        @return: The instantiated root node
+        """
+        root = None
+        count = 1
+
+        # (JSON of the node, parent Node)
+        stack = [(node_json, None)]
+        while stack:
+            current_json, parent = stack.pop()
+
+            # Previous node is already a leaf node
+            if not current_json:
+                continue
+
+            # Instantiate a Node subclass
+            node = self.instantiate_node(current_json)
+            if node is None:
+                continue
+            if parent is None:
+                root = node
             else:
-                node.left = self._build_tree_recursive(plans[0], count)
-                node.right = self._build_tree_recursive(plans[1], count)
+                if not parent.children:
+                    parent.children = []
+                parent.children.append(node)
+
+            node.id = count  # Assign the current count as the node number
+            count += 1  # Increment the count for the next node
 
-            # node.node_json["Plans"] no longer needed, empty it to save storage
-            node.node_json["Plans"] = {}
+            # Continue with every child node, e.g. all partitions of an Append.
+            # They are pushed in reverse so that the first one is popped first
+            stack.extend((plan, node) for plan in reversed(current_json.get("Plans", [])))
 
-        return node
+        return root
 
     def explain_all_nodes(self, node):
         """
-        Perform depth-first traversal of the query tree to obtain
+        Perform post-order traversal of the query tree to obtain
         the explanations for all of the nodes in the tree
 
         @param node: Current node to explain.
                      On first call of the function, node = root.
-                     Otherwise, node is either node.left or node.right
         @return: The output for the entire tree
         """
+        self.full_output = self.full_output + "".join(self.iter_explanations(node))
+        return self.full_output
+
+    def iter_explanations(self, node):
+        """
+        Explain the subtree rooted at node in post-order, yielding the output of
+        each node, with its separator, as soon as it is ready. The first chunk
+        is available once the first leaf is explained, not the whole plan.
+
+        @param node: The root of the subtree to explain
+        """
+        if self.max_workers > 1:
+            yield from self.iter_explanations_parallel(node)
+            return
+
+        stack = [(node, False)] if node is not None else []
+        while stack:
+            current, children_done = stack.pop()
+            if not children_done:
+                # Explain the children first, in order
+                stack.append((current, True))
+                stack.extend((child, False) for child in reversed(current.children))
+                continue
+
+            yield self.explanation_chunk(current, self.explain_node(current, self.order))
+
+    def iter_explanations_parallel(self, node):
+        """
+        Explain the subtree rooted at node like iter_explanations(), but run
+        independent nodes, e.g. the two sides of a join or the partitions of
+        an Append, at the same time on max_workers threads. Their time goes
+        mostly to catalog queries, which do not hold the GIL.
+
+        A node is started once all of its children are explained, so its
+        merge_dict() sees their parent_dict. Every thread explains on its own
+        forked session. The chunks are still yielded in post-order.
+
+        @param node: The root of the subtree to explain
+        """
+        # Post-order of the subtree, which decides the order of the output
+        nodes = []
+        stack = [(node, False)] if node is not None else []
+        while stack:
+            current, children_done = stack.pop()
+            if children_done:
+                nodes.append(current)
+                continue
+            stack.append((current, True))
+            stack.extend((child, False) for child in reversed(current.children))
+        orders = {current.id: self.order + index for index, current in enumerate(nodes)}
+
+        # Load the settings before any thread reads them through subtree_key()
+        self.session.settings
+        sessions = queue.Queue()
+        forked = [self.session.fork() for _ in range(min(self.max_workers, len(nodes)))]
+        for session in forked:
+            sessions.put(session)
+
+        def explain(current):
+            session = sessions.get()
+            current.session = session
+            try:
+                return self.explain_node(current, orders[current.id])
+            finally:
+                current.session = self.session
+                sessions.put(session)
+
+        # Number of children of every node that are not explained yet
+        waiting = {current.id: len(current.children) for current in nodes}
+        parents = {child.id: current for current in nodes for child in current.children}
+        outputs = {}
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            running = {
+                executor.submit(explain, current): current
+                for current in nodes
+                if not current.children
+            }
+            next_index = 0
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    current = running.pop(future)
+                    outputs[current.id] = future.result()
+
+                    # Start the parent once its last child is explained
+                    parent = parents.get(current.id)
+                    if parent is not None:
+                        waiting[parent.id] -= 1
+                        if waiting[parent.id] == 0:
+                            running[executor.submit(explain, parent)] = parent
+
+                # Yield every node whose predecessors in post-order are done
+                while next_index < len(nodes) and nodes[next_index].id in outputs:
+                    current = nodes[next_index]
+                    yield self.explanation_chunk(current, outputs.pop(current.id))
+                    next_index += 1
+        finally:
+            executor.shutdown(cancel_futures=True)
+            for session in forked:
+                session.close()
+
+    def explanation_chunk(self, node, output):
+        """
+        @param node: The node that was explained
+        @param output: Its output
+        @return: The output followed by the separator to the next node
+        """
+        # Add separators to distinguish between different nodes
+        chunk = output + "\n"
+        if node is not self.root:
+            chunk = chunk + "~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~\n\n"
+
+        # Increment current node order
+        self.order += 1
+        return chunk
+
+    def explain_node(self, node, order):
+        """
+        Explain a single node whose children already have their parent_dict
+
+        @param node: The node to explain
+        @param order: The order in which this node is being explained
+        @return: The output of the node
+        """
+
+        # A subtree with the same plan was explained before, reuse its
+        # estimates. The measurements of this run are explained below
+        key = self.subtree_key(node)
+        cached = subtree_cache.get(key)
+        if cached is not None:
+            body, node.parent_dict, formula, difference = cached
+            node.str_explain_formula, node.str_explain_difference = formula, difference
+            node.output = node.header(order) + body
+            with self._counts_lock:
+                self.nodes_reused += 1
+        else:
+            self.explain_shape(node, order)
+            subtree_cache.put(
+                key,
+                (
+                    node.output[len(node.header(order)) :],
+                    node.parent_dict,
+                    node.str_explain_formula,
+                    node.str_explain_difference,
+                ),
+            )
+
+        node.explain_measurements()
+
+        return node.output
+
+    def explain_shape(self, node, order):
+        """
+        The estimates of a node whose subtree was not explained before. A node
+        of the same shape in a plan of another query shares everything but
+        PostgreSQL's Total Cost, which differs with the literals
+
+        @param node: The node to explain
+        @param order: The order in which this node is being explained
+        """
+        key = self.shape_key(node)
+        shared = explanation_cache.get(key)
+        if shared is not None:
+            estimates, calculated_cost, parent_dict, formula, difference = shared
+            node.str_explain_formula, node.str_explain_difference = formula, difference
+            node.output = node.header(order) + estimates
+            node.compare_cost(calculated_cost)
+            node.parent_dict = dict(parent_dict, postgre_cost=node.node_json["Total Cost"])
+            with self._counts_lock:
+                self.nodes_shared += 1
+            return
+
+        # Merge the children's parent_dict before processing current node
+        node.merge_dict()
+
+        # Define any explanations here after info from children nodes are received
+        node.define_explanations()
+
+        calculated_cost = node.estimate_cost(order)
+        estimates = node.output[len(node.header(order)) :]
+        node.compare_cost(calculated_cost)
+        node.parent_dict = node.build_parent_dict()
+        explanation_cache.put(
+            key,
+            (
+                estimates,
+                calculated_cost,
+                node.parent_dict,
+                node.str_explain_formula,
+                node.str_explain_difference,
+            ),
+        )
+        with self._counts_lock:
+            self.nodes_recomputed += 1
+
+    def explain_node_lazily(self, node):
+        """
+        Explain one node on demand, e.g. when it is selected in the interface.
+        Only the parent_dict of the nodes below it are computed, not their
+        explanations. Results are cached on the tree.
+
+        @param node: The node to explain
+        @return: The output of the node
+        """
+        if node.id in self.lazy_outputs:
+            return self.lazy_outputs[node.id]
+
+        # The session is only held while explaining, the user may browse for a while
+        with self:
+            for child in node.children:
+                self.ensure_parent_dict(child)
+            output = self.explain_node(node, self.post_order()[node.id])
+
+        self.lazy_outputs[node.id] = output
+        return output
+
+    def ensure_parent_dict(self, node):
+        """
+        Compute the parent_dict of every node in the subtree rooted at node
+        that does not have one yet, children first
+        """
+        pending = [node]
+        order = []
+        while pending:
+            current = pending.pop()
+            if current.parent_dict is not None:
+                continue
+            order.append(current)
+            pending.extend(current.children)
+
+        for current in reversed(order):
+            current.merge_dict()
+            current.parent_dict = current.build_parent_dict()
+
+    def post_order(self):
+        """
+        @return: A dict of node id -> the order explain_all_nodes would explain it in
+        """
+        if self._post_order is None:
+            self._post_order = {}
+            stack = [(self.root, False)] if self.root is not None else []
+            while stack:
+                node, children_done = stack.pop()
+                if children_done:
+                    self._post_order[node.id] = len(self._post_order) + 1
+                    continue
+                stack.append((node, True))
+                stack.extend((child, False) for child in reversed(node.children))
+        return self._post_order
+
+    def explain_summary(self):
+        """
+        Explain the measurements EXPLAIN reports for the query as a whole:
+        planning and execution time, trigger time, JIT compilation and the
+        settings that differ from their defaults
 
-        if node is not None:
-            self.explain_all_nodes(node.left)
-            self.explain_all_nodes(node.right)
+        @return: The output string, empty if none of them were reported
+        """
+        lines = []
+        if "Cached At" in self.summary:
+            lines.append(
+                "Cached result of a previous run at "
+                + time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.summary["Cached At"]))
+                + ", the query was not executed again"
+            )
+        if "Planning Time" in self.summary:
+            lines.append("Planning Time: " + str(self.summary["Planning Time"]) + " ms")
+        lines.extend(
+            "Planning " + line for line in describe_buffers(self.summary.get("Planning", {}))
+        )
+        if "Execution Time" in self.summary:
+            lines.append("Execution Time: " + str(self.summary["Execution Time"]) + " ms")
+
+        for trigger in self.summary.get("Triggers", []):
+            lines.append(
+                "Trigger '"
+                + str(trigger.get("Trigger Name"))
+                + "' on relation '"
+                + str(trigger.get("Relation"))
+                + "': "
+                + str(trigger.get("Time", 0))
+                + " ms over "
+                + str(trigger.get("Calls", 0))
+                + " calls"
+            )
+
+        jit = self.summary.get("JIT")
+        if jit:
+            timing = jit.get("Timing", {})
+            lines.append(
+                "JIT: "
+                + str(jit.get("Functions", 0))
+                + " functions compiled in "
+                + str(timing.get("Total", 0))
+                + " ms (generation "
+                + str(timing.get("Generation", 0))
+                + " ms, inlining "
+                + str(timing.get("Inlining", 0))
+                + " ms, optimization "
+                + str(timing.get("Optimization", 0))
+                + " ms, emission "
+                + str(timing.get("Emission", 0))
+                + " ms)"
+            )
+
+        if self.nodes_reused or self.nodes_shared:
+            lines.append(
+                "Nodes explained: "
+                + str(self.nodes_recomputed)
+                + " recomputed, "
+                + str(self.nodes_reused)
+                + " reused from a previous run, "
+                + str(self.nodes_shared)
+                + " from a plan of the same shape"
+            )
+
+        settings = self.summary.get("Settings")
+        if settings:
+            lines.append(
+                "Modified Settings: "
+                + ", ".join(name + " = " + str(value) for name, value in settings.items())
+            )
+
+        if not lines:
+            return ""
+        return "Query Summary\n\n" + "\n".join(lines)
+
+    def iter_nodes(self):
+        """
+        Iterate over every node of the tree in pre-order
+        """
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.children))
+
+    def prefetch_stats(self):
+        """
+        Collect every (relation, attribute) pair that the nodes will ask
+        statistics for, then fetch the block counts, tuple estimates and
+        n_distinct values of all of them, along with the session's settings
+        snapshot, in a single catalog query.
+
+        The results seed stats_cache so that B(), T(), V() and M() do not
+        query the database again. Anything not covered, e.g. attributes
+        without pg_stats entries, is still fetched on demand.
+
+        Pairs that were prefetched recently, e.g. by prefetch_query_stats()
+        while the query was running, are not fetched again. If none are
+        left, the settings snapshot is taken from stats_cache as well.
+        """
+        prefetch = self.stats_prefetch_query()
+        if prefetch is not None:
+            requests, query = prefetch
+            self.seed_stats(requests, self.session.execute(query))
+
+    def stats_prefetch_query(self):
+        """
+        Build the catalog query of prefetch_stats(), for the pairs that were
+        not prefetched recently. If none are left, seed the settings snapshot
+        from stats_cache instead.
+
+        @return: A tuple of (set of (relation, attribute) pairs, SQL string),
+                 or None if there is nothing to fetch
+        """
+        database = stats_database(self.login_details, self.query_details.database)
+
+        requests = set()
+        for node in self.iter_nodes():
+            requests.update(node.stats_requests())
+        requests = {
+            request
+            for request in requests
+            if stats_cache.get(("prefetched", database) + request) is None
+        }
+        if not requests:
+            settings = stats_cache.get(("settings", database))
+            if settings is not None:
+                self.session.seed_settings(settings)
+            return None
+
+        values = ", ".join(
+            "("
+            + quote_literal(relation)
+            + "::text, "
+            + (quote_literal(attribute) if attribute else "NULL")
+            + "::text)"
+            for relation, attribute in sorted(requests, key=str)
+        )
+        query = """
+        SELECT w.rel, w.attr, c.reltuples, c.relpages,
+               pg_relation_size(c.oid) / current_setting('block_size')::int AS num_blocks,
+               st.n_live_tup, s.n_distinct,
+               (SELECT json_agg(json_build_array(name, setting, unit, vartype))
+                FROM pg_settings WHERE name IN ({names})) AS settings
+        FROM (VALUES {values}) AS w(rel, attr)
+        JOIN pg_class c ON c.oid = to_regclass(w.rel)
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        LEFT JOIN pg_stat_user_tables st ON st.relid = c.oid
+        LEFT JOIN pg_stats s ON s.schemaname = n.nspname
+                            AND s.tablename = c.relname
+                            AND s.attname = w.attr
+        """.format(
+            values=values,
+            names=", ".join(quote_literal(name) for name in COST_SETTINGS),
+        )
+        return requests, query
+
+    def seed_stats(self, requests, rows):
+        """
+        Store the result of the query built by stats_prefetch_query() in
+        stats_cache and the session's settings snapshot
+
+        @param requests: The (relation, attribute) pairs the query asked for
+        @param rows: All rows of its result, or None if it failed
+        """
+        if not rows:
+            return
+
+        database = stats_database(self.login_details, self.query_details.database)
 
-            # After calling explain() on both child nodes
-            # Merge their parent_dict before processing current node
-            node.merge_dict()
+        # Every row carries the same settings snapshot
+        self.session.seed_settings(rows[0][7])
+        stats_cache.put(("settings", database), rows[0][7])
 
-            # Define any explanations here after info from children nodes are received
-            node.define_explanations()
+        # Exact counts do not seed the tuple estimates, the pairs are not complete
+        if not self.exact_counts:
+            for request in requests:
+                stats_cache.put(("prefetched", database) + request, True)
 
-            # Append the explanation of the node to the full string
-            # And add separators to distinguish between different nodes
-            self.full_output = self.full_output + node.explain(self.order) + "\n"
-            if node is not self.root:
-                self.full_output = (
-                    self.full_output + "~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~\n\n"
+        for rel, attr, reltuples, relpages, num_blocks, n_live_tup, n_distinct, _ in rows:
+            stats_cache.put(("blocks", database, rel), num_blocks)
+            if self.exact_counts:
+                continue
+
+            num_tuples = tuples_from_catalog(reltuples, relpages, num_blocks, n_live_tup)
+            stats_cache.put(("tuples", database, rel), num_tuples)
+            if attr is not None and n_distinct is not None:
+                stats_cache.put(
+                    ("distinct", database, rel, attr),
+                    distinct_from_catalog(n_distinct, num_tuples[0]),
                 )
 
-            # Increment current node order
-            self.order += 1
+    def close(self):
+        """
+        Return the tree's database connection to the pool
+        """
+        self.session.close()
+
+    def __enter__(self):
+        return self
 
-        return self.full_output
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
     def instantiate_node(self, node_json):
         """
@@ -226,75 +2528,113 @@ class Tree(object):
         """
         match node_json["Node Type"]:
             case "Seq Scan":
-                return SeqScanNode(node_json, self.login_details, self.query_details)
+                node_class = SeqScanNode
             case "Index Scan":
-                return IndexScanNode(node_json, self.login_details, self.query_details)
+                node_class = IndexScanNode
             case "Index Only Scan":
-                return IndexOnlyScanNode(
-                    node_json, self.login_details, self.query_details
-                )
+                node_class = IndexOnlyScanNode
             case "Bitmap Index Scan":
-                return BitmapIndexScanNode(
-                    node_json, self.login_details, self.query_details
-                )
+                node_class = BitmapIndexScanNode
             case "Bitmap Heap Scan":
-                return BitmapHeapScanNode(
-                    node_json, self.login_details, self.query_details
-                )
+                node_class = BitmapHeapScanNode
             case "Bitmap And":
-                return BitmapAndNode(node_json, self.login_details, self.query_details)
+                node_class = BitmapAndNode
             case "Bitmap Or":
-                return BitmapOrNode(node_json, self.login_details, self.query_details)
+                node_class = BitmapOrNode
             case "CTE Scan":
-                return CTEScanNode(node_json, self.login_details, self.query_details)
+                node_class = CTEScanNode
             case "Subquery Scan":
-                return SubqueryScanNode(
-                    node_json, self.login_details, self.query_details
-                )
+                node_class = SubqueryScanNode
             case "Append":
-                return AppendNode(node_json, self.login_details, self.query_details)
+                node_class = AppendNode
             case "MergeAppend":
-                return MergeAppendNode(
-                    node_json, self.login_details, self.query_details
-                )
+                node_class = MergeAppendNode
             case "Nested Loop":
-                return NestedLoopJoinNode(
-                    node_json, self.login_details, self.query_details
-                )
+                node_class = NestedLoopJoinNode
             case "Merge Join":
-                return MergeJoinNode(node_json, self.login_details, self.query_details)
+                node_class = MergeJoinNode
             case "Hash":
-                return HashNode(node_json, self.login_details, self.query_details)
+                node_class = HashNode
             case "Hash Join":
-                return HashJoinNode(node_json, self.login_details, self.query_details)
+                node_class = HashJoinNode
             case "Gather":
-                return GatherNode(node_json, self.login_details, self.query_details)
+                node_class = GatherNode
             case "Gather Merge":
-                return GatherMergeNode(
-                    node_json, self.login_details, self.query_details
-                )
+                node_class = GatherMergeNode
             case "Sort":
-                return SortNode(node_json, self.login_details, self.query_details)
+                node_class = SortNode
             case "Incremental Sort":
-                return IncrementalSortNode(
-                    node_json, self.login_details, self.query_details
-                )
+                node_class = IncrementalSortNode
             case "Limit":
-                return LimitNode(node_json, self.login_details, self.query_details)
+                node_class = LimitNode
             case "Materialize":
-                return MaterializeNode(
-                    node_json, self.login_details, self.query_details
-                )
+                node_class = MaterializeNode
             case "Memoize":
-                return MemoizeNode(node_json, self.login_details, self.query_details)
+                node_class = MemoizeNode
             case "Group":
-                return GroupNode(node_json, self.login_details, self.query_details)
+                node_class = GroupNode
             case "Aggregate":
-                return AggregateNode(node_json, self.login_details, self.query_details)
+                node_class = AggregateNode
             case "Unique":
-                return UniqueNode(node_json, self.login_details, self.query_details)
+                node_class = UniqueNode
             case _:
-                return Node(node_json, self.login_details, self.query_details)
+                node_class = Node
+
+        return node_class(
+            node_json,
+            self.login_details,
+            self.query_details,
+            self.session,
+            self.exact_counts,
+            self.options,
+        )
+
+
+class NodeFields(Mapping):
+    """
+    A read-only view of the fields of one node of PostgreSQL's EXPLAIN JSON
+    output, without its "Plans". The fields are read from the JSON itself,
+    which plan_cache usually holds anyway, instead of being copied. Building
+    a tree does not modify the plan.
+
+    After Node.merge_dict(), keys like "Left block_size" or "Right Node Type"
+    are looked up in the parent_dict of the first and second child when they
+    are read, instead of being copied into every node.
+
+    @param node_json: The JSON / dictionary of details specific to the node
+    """
+
+    __slots__ = ("fields", "children")
+
+    CHILD_PREFIXES = {"Left": 0, "Right": 1}
+
+    def __init__(self, node_json):
+        self.fields = node_json
+        self.children = ()
+
+    def __getitem__(self, key):
+        if key != "Plans" and key in self.fields:
+            return self.fields[key]
+        return self._child_field(key)
+
+    def __contains__(self, key):
+        return key != "Plans" and key in self.fields
+
+    def __iter__(self):
+        return (key for key in self.fields if key != "Plans")
+
+    def __len__(self):
+        return len(self.fields) - ("Plans" in self.fields)
+
+    def _child_field(self, key):
+        side, _, child_key = key.partition(" ")
+        index = self.CHILD_PREFIXES.get(side)
+        if index is None or index >= len(self.children):
+            raise KeyError(key)
+        parent_dict = self.children[index].parent_dict
+        if parent_dict is None or child_key not in parent_dict:
+            raise KeyError(key)
+        return parent_dict[child_key]
 
 
 class Node(object):
@@ -310,31 +2650,138 @@ class Node(object):
     @param node_json: The JSON / dictionary of details specific to the node
     @param login_details: User-provided login details to the UI
     @param query_details: Contains the user-selected database and user-input query
+    @param session: The DatabaseSession of the owning Tree. If None, every
+                    helper query opens its own pooled connection
+    @param exact_counts: Whether T() counts tuples with a full scan instead
+                         of reading the catalog estimates
+    @param options: The ExplainOptions that produced node_json. Measurements
+                    that were not requested are not explained
     """
 
-    def __init__(self, node_json, login_details, query_details):
+    # Plans can have tens of thousands of nodes, do not give each one a __dict__.
+    # Subclasses must declare __slots__ = () as well
+    __slots__ = (
+        "login_details",
+        "query_details",
+        "session",
+        "exact_counts",
+        "options",
+        "node_json",
+        "children",
+        "parent_dict",
+        "id",
+        "subtree_hash",
+        "shape_hash",
+        "_output_parts",
+        "_formula_parts",
+        "_difference_parts",
+    )
+
+    def __init__(
+        self,
+        node_json,
+        login_details,
+        query_details,
+        session=None,
+        exact_counts=False,
+        options=EXPLAIN_ANALYZE,
+    ):
         # Stores user-input details
         self.login_details = login_details
         self.query_details = query_details
+        self.session = session
+        self.exact_counts = exact_counts
+        self.options = options
 
-        # The JSON of this particular node
-        self.node_json = node_json
+        # The fields of this particular node
+        self.node_json = NodeFields(node_json)
 
-        # Left and right child Node
-        self.left = None
-        self.right = None
+        # Child Nodes, in the order of node_json["Plans"]. Most nodes have one
+        # or two, Append and similar nodes can have thousands. Leaves share
+        # an empty tuple, Tree gives a node a list when it adds a child
+        self.children = ()
 
         # The entire output string that will be printed by the interface.
         # This variable should ONLY be modified between when explain() is triggered
         # and when explain() is returned
         self.output = ""
 
+        # Explanations set by define_explanations()
+        self.str_explain_formula = ""
+        self.str_explain_difference = ""
+
         # Dict data structure to pass to parent
         self.parent_dict = None
 
         # Id for node for easy reference
         self.id = None
 
+        # Hashes of the subtree rooted at this node and of its shape, see Tree.hash_subtrees()
+        self.subtree_hash = None
+        self.shape_hash = None
+
+    # output, str_explain_formula and str_explain_difference are built by
+    # append(), which adds to a list of parts. The parts are only joined
+    # when the string is read, so building a string is linear in its length
+    # instead of quadratic with repeated concatenation. A string that is not
+    # being built is kept as is, not as a list
+
+    @property
+    def output(self):
+        return self._joined("_output_parts")
+
+    @output.setter
+    def output(self, value):
+        self._output_parts = value
+
+    @property
+    def str_explain_formula(self):
+        return self._joined("_formula_parts")
+
+    @str_explain_formula.setter
+    def str_explain_formula(self, value):
+        self._formula_parts = value
+
+    @property
+    def str_explain_difference(self):
+        return self._joined("_difference_parts")
+
+    @str_explain_difference.setter
+    def str_explain_difference(self, value):
+        self._difference_parts = value
+
+    def _joined(self, name):
+        """
+        Join a list of parts into one string, and keep the string instead
+        so that the next read does not join again
+        """
+        parts = getattr(self, name)
+        if isinstance(parts, list):
+            parts = "".join(parts)
+            setattr(self, name, parts)
+        return parts
+
+    @property
+    def left(self):
+        """
+        The first child Node, e.g. the outer relation of a join. None if this is a leaf
+        """
+        return self.children[0] if self.children else None
+
+    @property
+    def right(self):
+        """
+        The second child Node, e.g. the inner relation of a join. None if there is none
+        """
+        return self.children[1] if len(self.children) > 1 else None
+
+    @property
+    def raw_json(self):
+        """
+        The JSON this node was built from, "Plans" included
+        """
+        return self.node_json.fields
+
     def define_explanations(self):
         # Given formula or how formula is derived
         self.str_explain_formula = "str_explain_formula"
@@ -361,15 +2808,41 @@ class Node(object):
         @param order : The order in which this Node is being explained, relative
                        to the entire query tree
         """
+        self.explain_estimates(order)
+        self.explain_measurements()
+        return self.output
+
+    def explain_estimates(self, order=0):
+        """
+        The part of explain() that only depends on the plan: the calculated
+        cost against PostgreSQL's, and the parent_dict. Tree caches it for
+        subtrees with the same plan fields
+
+        @param order : The order in which this Node is being explained
+        """
+
+        calculated_cost = self.estimate_cost(order)
+        self.compare_cost(calculated_cost)
+
+        # This node has been explained once
+        # Build a dict to pass to parent to mark this Node as explained
+        self.parent_dict = self.build_parent_dict()
+
+        return self.output
+
+    def estimate_cost(self, order=0):
+        """
+        Start the output with the formula and the calculated cost
+
+        @param order : The order in which this Node is being explained
+        @return: The calculated cost
+        """
 
         # Reset the output just in case
         self.output = ""
 
         # Briefly introduce the node with the name of the Node Type
-        self.append(
-            str(order) + ". " + self.node_json["Node Type"] + " (#" + str(self.id) + ")"
-        )
-        self.append()
+        self.output = self.header(order)
 
         # Append the formula explanation
         self.append(self.str_explain_formula)
@@ -379,6 +2852,16 @@ class Node(object):
         self.append("Calculated Cost: " + str(calculated_cost))
         self.append()
 
+        return calculated_cost
+
+    def compare_cost(self, calculated_cost):
+        """
+        Append PostgreSQL's total cost and how the calculated cost compares to
+        it. The only part of the estimates that depends on the literals of the query
+
+        @param calculated_cost: The result of manual_cost()
+        """
+
         # Append the PostgreSQL total cost
         self.append(
             "PostgreSQL Total Cost: " + str(self.node_json.get("Total Cost", "Unknown"))
@@ -397,12 +2880,191 @@ class Node(object):
             self.append("Reason for difference:")
             self.append(self.str_explain_difference)
 
-        # This node has been explained once
-        # Build a dict to pass to parent to mark this Node as explained
-        self.parent_dict = self.build_parent_dict()
+    def explain_measurements(self):
+        """
+        The part of explain() that changes from one run of the plan to the next
+        """
+        # Compare the estimates with what actually happened, if the query was executed
+        if self.options.analyze:
+            self.explain_actual()
+
+        # Buffer and WAL usage, if requested
+        self.explain_diagnostics()
 
         return self.output
 
+    # Keys of node_json measured while executing the query, besides those
+    # starting with "Actual". They vary between runs of the same plan.
+    # "Sort Method" is measured too but decides the Sort explanation
+    MEASURED_KEYS = frozenset(
+        (
+            "Workers",
+            "Workers Launched",
+            "Heap Fetches",
+            "Rows Removed by Filter",
+            "Rows Removed by Index Recheck",
+            "Rows Removed by Join Filter",
+            "Exact Heap Blocks",
+            "Lossy Heap Blocks",
+            "Sort Space Used",
+            "Sort Space Type",
+            "Full-sort Groups",
+            "Pre-sorted Groups",
+            "Hash Buckets",
+            "Original Hash Buckets",
+            "Hash Batches",
+            "Original Hash Batches",
+            "Peak Memory Usage",
+            "Disk Usage",
+            "HashAgg Batches",
+            "Cache Hits",
+            "Cache Misses",
+            "Cache Evictions",
+            "Cache Overflows",
+            "Conflicting Tuples",
+            "Tuples Inserted",
+            "I/O Read Time",
+            "I/O Write Time",
+            "Temp I/O Read Time",
+            "Temp I/O Write Time",
+        )
+    )
+
+    # Prefixes of the buffer and WAL counters
+    MEASURED_PREFIXES = ("Actual ", "Shared ", "Local ", "Temp ", "WAL ")
+
+    def plan_fields(self):
+        """
+        @return: The fields of node_json decided by the planner, without the
+                 measurements of EXPLAIN ANALYZE, BUFFERS and WAL
+        """
+        return {
+            key: value
+            for key, value in self.node_json.items()
+            if key not in self.MEASURED_KEYS and not key.startswith(self.MEASURED_PREFIXES)
+        }
+
+    # Keys of node_json that decide the estimates of a node, besides its
+    # costs and the conditions below
+    SHAPE_KEYS = (
+        "Node Type",
+        "Relation Name",
+        "Alias",
+        "Index Name",
+        "Strategy",
+        "Sort Method",
+        "Join Type",
+        "Parent Relationship",
+        "Plan Width",
+        "Sort Key",
+        "Group Key",
+    )
+
+    # Keys of the conditions, whose literals are not part of the shape
+    CONDITION_KEYS = (
+        "Filter",
+        "Index Cond",
+        "Recheck Cond",
+        "Hash Cond",
+        "Merge Cond",
+        "Join Filter",
+    )
+
+    # String and numeric literals in conditions
+    LITERAL_PATTERN = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+    # What count_conditions() and the condition parsers look for in a condition
+    CONDITION_MARKERS = re.compile(r"AND|[<>=~:]")
+
+    @classmethod
+    def mask_literal(cls, match):
+        """
+        @return: "?" for a literal, unless it contains a marker of
+                 CONDITION_MARKERS, which changes how the condition is parsed
+        """
+        literal = match.group()
+        if cls.CONDITION_MARKERS.search(literal):
+            return literal
+        return "?"
+
+    def shape(self):
+        """
+        Describe this node like plan_fields() does but without its costs,
+        and with the literals of its conditions replaced. Nodes of the same
+        shape get the same estimates, see Tree.explain_shape()
+
+        @return: A string
+        """
+        fields = self.node_json.fields
+        shape = [key + "\0" + str(fields[key]) for key in self.SHAPE_KEYS if key in fields]
+        shape.extend(
+            key + "\0" + self.LITERAL_PATTERN.sub(self.mask_literal, fields[key])
+            for key in self.CONDITION_KEYS
+            if key in fields
+        )
+        return "\0".join(shape)
+
+    def explain_actual(self):
+        """
+        Append the actual rows and times measured by EXPLAIN ANALYZE
+        next to the planner's estimates
+        """
+        if "Actual Rows" not in self.node_json:
+            return
+
+        self.append()
+        self.append(
+            "Estimated Rows: "
+            + str(self.node_json.get("Plan Rows", "Unknown"))
+            + ", Actual Rows: "
+            + str(self.node_json["Actual Rows"])
+            + " (over "
+            + str(self.node_json.get("Actual Loops", 1))
+            + " loops)"
+        )
+        if "Actual Total Time" in self.node_json:
+            self.append(
+                "Actual Time: "
+                + str(self.node_json.get("Actual Startup Time", 0))
+                + " ms to first row, "
+                + str(self.node_json["Actual Total Time"])
+                + " ms in total per loop"
+            )
+        elif not self.options.timing:
+            self.append("Actual Time: not measured (TIMING OFF)")
+
+    def explain_diagnostics(self):
+        """
+        Append the buffer, I/O timing and WAL usage of this node. Only the
+        fields present in node_json are explained, which depends on the
+        ExplainOptions and on server settings such as track_io_timing
+        """
+        lines = describe_buffers(self.node_json)
+        if "WAL Records" in self.node_json:
+            lines.append(
+                "WAL: "
+                + str(self.node_json["WAL Records"])
+                + " records, "
+                + str(self.node_json.get("WAL FPI", 0))
+                + " full page images, "
+                + str(self.node_json.get("WAL Bytes", 0))
+                + " bytes"
+            )
+
+        if lines:
+            self.append()
+            for line in lines:
+                self.append(line)
+
+    def header(self, order=0):
+        """
+        @return: The first lines of the explanation, which introduce the node
+                 with the name of the Node Type
+        """
+        return (
+            str(order) + ". " + self.node_json["Node Type"] + " (#" + str(self.id) + ")\n\n"
+        )
+
     def build_parent_dict(self):
         """
         Builds a dict of specific values to pass to the parent Node for their
@@ -431,13 +3093,20 @@ class Node(object):
         Obtains the dictionary created by the left and right childs if any
         Then, label the dict to each child, and merge the two dictionaries
         with the JSON provided by PostgreSQL into one big dictionary.
+
+        Only the first two children are merged. Nodes with any number of
+        children read the dicts of all of them with sum_children() instead.
+        The dicts are not copied, NodeFields looks the labelled keys up in
+        the children when they are read.
+        """
+        self.node_json.children = self.children
+
+    def sum_children(self, key):
         """
-        if self.left is not None:
-            for key, value in self.left.parent_dict.items():
-                self.node_json["Left " + key] = value
-        if self.right is not None:
-            for key, value in self.right.parent_dict.items():
-                self.node_json["Right " + key] = value
+        @param key: A key of the children's parent_dict, e.g. "tuple_size"
+        @return: The sum of the value of key over every child
+        """
+        return sum(child.parent_dict[key] for child in self.children)
 
     def append(self, tgt: str = "", src: str = "output", eol: str = "\n"):
         """
@@ -457,14 +3126,53 @@ class Node(object):
 
         match src:
             case "formula":
-                self.str_explain_formula = self.str_explain_formula + tgt + eol
+                name = "_formula_parts"
             case "difference":
-                self.str_explain_difference = self.str_explain_difference + tgt + eol
+                name = "_difference_parts"
             case _:
-                self.output = self.output + tgt + eol
+                name = "_output_parts"
+        parts = getattr(self, name)
+        if isinstance(parts, str):
+            parts = [parts]
+            setattr(self, name, parts)
+        parts.append(tgt)
+        parts.append(eol)
 
     ######### Functions that Re-queries the Database #########
 
+    def query(self, query: str):
+        """
+        Run a catalog query on the tree's session
+
+        @param query : The SQL string to execute
+        @return: All rows of the result
+        """
+        if self.session is not None:
+            return self.session.execute(query)
+
+        return retrieve_query(self.login_details, replace(self.query_details, query=query), False)
+
+    def stats_requests(self):
+        """
+        List the statistics this node will ask for, so that the Tree can
+        prefetch them in a single query
+
+        @return: A list of (relation, attribute) pairs. attribute is None when
+                 only the relation-level statistics are needed
+        """
+        if "Relation Name" in self.node_json:
+            return [(self.node_json["Relation Name"], None)]
+        return []
+
+    def stats_key(self, kind: str, *names):
+        """
+        @return: The stats_cache key of a statistic of this node's database
+        """
+        return (
+            kind,
+            stats_database(self.login_details, self.query_details.database),
+        ) + names
+
     def B(self, relation: str, show: bool = True):
         """
         Return number of blocks for the specified relation
@@ -474,17 +3182,16 @@ class Node(object):
         """
 
         # Prepare the query
-        query_details = QueryDetails
-        query_details.database = self.query_details.database
-        query_details.query = """
+        query = """
         SELECT pg_relation_size('{rel}') / current_setting('block_size')::int AS num_blocks
         """.format(
             rel=relation
         )
 
-        # Execute and retrieve the values
-        result = retrieve_query(self.login_details, query_details, False)
-        num_blocks = result[0][0]
+        # Execute and retrieve the values, unless already cached
+        num_blocks = stats_cache.get_or_load(
+            self.stats_key("blocks", relation), lambda: self.query(query)[0][0]
+        )
 
         if show:
             self.append(
@@ -496,46 +3203,92 @@ class Node(object):
         """
         Return number of tuples for the specified relation
 
+        By default the number is estimated from the planner statistics in
+        pg_class and pg_stat_user_tables, which costs the same for any table
+        size. If exact_counts is set, the relation is scanned with COUNT(*).
+
         @param relation : The relation to query
         @param show : Whether to print out the results of the query
         """
 
-        # Prepare the query
-        query_details = QueryDetails
-        query_details.database = self.query_details.database
-        query_details.query = """
-        SELECT COUNT(*) as num_tuples FROM {rel}
-        """.format(
-            rel=relation
-        )
+        if self.exact_counts:
+            # Prepare the query
+            query = """
+            SELECT COUNT(*) as num_tuples FROM {rel}
+            """.format(
+                rel=relation
+            )
 
-        # Execute and retrieve the values
-        result = retrieve_query(self.login_details, query_details, False)
-        num_tuples = result[0][0]
+            # Execute and retrieve the values, unless already cached
+            num_tuples, source = stats_cache.get_or_load(
+                self.stats_key("tuples_exact", relation),
+                lambda: (self.query(query)[0][0], "exact COUNT(*)"),
+            )
+        else:
+            num_tuples, source = stats_cache.get_or_load(
+                self.stats_key("tuples", relation),
+                lambda: self.estimate_tuples(relation),
+            )
 
         if show:
             self.append(
-                "Number of tuples for relation '" + relation + "': " + str(num_tuples)
+                "Number of tuples for relation '"
+                + relation
+                + "': "
+                + str(num_tuples)
+                + " ("
+                + source
+                + ")"
             )
         return num_tuples
 
-    def M(self, show: bool = True):
+    def estimate_tuples(self, relation: str):
         """
-        Return buffer size allocated to DBMS in memory
+        Estimate the number of tuples of a relation from the catalog
+        with tuples_from_catalog()
 
-        @param show : Whether to print out the results of the query
+        @param relation : The relation to query
+        @return: A tuple of (number of tuples, description of where it came from)
         """
 
         # Prepare the query
-        query_details = QueryDetails
-        query_details.database = self.query_details.database
-        query_details.query = """
-        SELECT setting FROM pg_settings WHERE name = 'shared_buffers';
+        query = """
+        SELECT c.reltuples, c.relpages,
+               pg_relation_size(c.oid) / current_setting('block_size')::int AS num_blocks,
+               s.n_live_tup
+        FROM pg_class c
+        LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+        WHERE c.oid = '{rel}'::regclass
+        """.format(
+            rel=relation
+        )
+
+        reltuples, relpages, num_blocks, n_live_tup = self.query(query)[0]
+
+        # The block count is exact, keep it for B()
+        stats_cache.put(self.stats_key("blocks", relation), num_blocks)
+
+        return tuples_from_catalog(reltuples, relpages, num_blocks, n_live_tup)
+
+    def setting(self, name: str):
         """
+        Return a planner setting from the session's snapshot
 
-        # Execute and retrieve the values
-        result = retrieve_query(self.login_details, query_details, False)
-        buffer_size = int(result[0][0])
+        @param name : The name of the setting, one of COST_SETTINGS,
+                      or its unit with an "_unit" suffix
+        """
+        if self.session is not None:
+            return self.session.settings[name]
+        return parse_settings(self.query(SETTINGS_QUERY))[name]
+
+    def M(self, show: bool = True):
+        """
+        Return buffer size allocated to DBMS in memory
+
+        @param show : Whether to print out the results of the query
+        """
+
+        buffer_size = self.setting("shared_buffers")
 
         if show:
             self.append("Buffer size: " + str(buffer_size))
@@ -546,23 +3299,33 @@ class Node(object):
         Return number of unique values for the attribute in
         the provided relation
 
+        By default the number is read from pg_stats.n_distinct. If the
+        attribute has no statistics, it is estimated from a sample of the
+        relation. If exact_counts is set, COUNT(DISTINCT) scans the relation.
+
         @param relation : The relation to query
         @param attribute : The attribute of the relation to query
         @param show : Whether to print out the results of the query
         """
 
-        # Prepare the query
-        query_details = QueryDetails
-        query_details.database = self.query_details.database
-        query_details.query = """
-        SELECT COUNT(DISTINCT {attr}) AS num_unique_values FROM {rel};
-        """.format(
-            attr=attribute, rel=relation
-        )
+        if self.exact_counts:
+            # Prepare the query
+            query = """
+            SELECT COUNT(DISTINCT {attr}) AS num_unique_values FROM {rel};
+            """.format(
+                attr=attribute, rel=relation
+            )
 
-        # Execute and retrieve the values
-        result = retrieve_query(self.login_details, query_details, False)
-        num_unique = result[0][0]
+            # Execute and retrieve the values, unless already cached
+            num_unique, source = stats_cache.get_or_load(
+                self.stats_key("distinct_exact", relation, attribute),
+                lambda: (self.query(query)[0][0], "exact COUNT(DISTINCT)"),
+            )
+        else:
+            num_unique, source = stats_cache.get_or_load(
+                self.stats_key("distinct", relation, attribute),
+                lambda: self.estimate_distinct(relation, attribute),
+            )
 
         if show:
             self.append(
@@ -572,9 +3335,102 @@ class Node(object):
                 + relation
                 + "': "
                 + str(num_unique)
+                + " ("
+                + source
+                + ")"
             )
         return num_unique
 
+    def estimate_distinct(self, relation: str, attribute: str):
+        """
+        Estimate the number of unique values of an attribute from pg_stats.
+        A negative n_distinct is a fraction of the number of tuples.
+
+        @param relation : The relation to query
+        @param attribute : The attribute of the relation to query
+        @return: A tuple of (number of unique values, description of where it came from)
+        """
+
+        # Prepare the query
+        query = """
+        SELECT s.n_distinct
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        JOIN pg_stats s ON s.schemaname = n.nspname
+                       AND s.tablename = c.relname
+                       AND s.attname = '{attr}'
+        WHERE c.oid = '{rel}'::regclass
+        """.format(
+            attr=attribute, rel=relation
+        )
+
+        result = self.query(query)
+        if not result or result[0][0] is None:
+            return self.sample_distinct(relation, attribute)
+
+        return distinct_from_catalog(result[0][0], self.T(relation, False))
+
+    def sample_distinct(self, relation: str, attribute: str, sample_rows=30000):
+        """
+        Estimate the number of unique values of an attribute from a block
+        sample of the relation, using the Guaranteed-Error Estimator (GEE):
+
+            D = sqrt(N / n) * f1 + (d - f1)
+
+        where N is the number of tuples, n the number of sampled tuples, d the
+        number of unique values in the sample and f1 the number of values seen
+        exactly once. The ratio error of GEE is bounded by sqrt(N / n). For a
+        relation without statistics, N is scaled up from the sample.
+
+        @param relation : The relation to query
+        @param attribute : The attribute of the relation to query
+        @param sample_rows : Approximate number of tuples to sample
+        @return: A tuple of (number of unique values, description of the estimate and its bounds)
+        """
+
+        num_tuples = self.T(relation, False)
+        percent = sample_percent(self.B(relation, False), num_tuples, sample_rows)
+
+        # Prepare the query
+        query = """
+        SELECT COALESCE(SUM(cnt), 0), COUNT(*), COUNT(*) FILTER (WHERE cnt = 1)
+        FROM (
+            SELECT {attr}, COUNT(*) AS cnt
+            FROM {rel} TABLESAMPLE SYSTEM ({pct}) REPEATABLE (0)
+            WHERE {attr} IS NOT NULL
+            GROUP BY {attr}
+        ) sample
+        """.format(
+            attr=attribute, rel=relation, pct=percent
+        )
+
+        n, d, f1 = self.query(query)[0]
+        n = int(n)
+        if n == 0:
+            return 0, "sampled " + format(percent, ".3g") + "% of relation, no values found"
+
+        # The sample is the whole relation, the count is exact
+        if percent >= 100.0 or (num_tuples and n >= num_tuples):
+            return d, "sampled the whole relation"
+
+        # Without statistics, scale the sample up to the relation
+        if not num_tuples:
+            num_tuples = round(n * 100.0 / percent)
+
+        ratio = sqrt(num_tuples / n)
+        estimate = ratio * f1 + (d - f1)
+        lower = max(d, estimate / ratio)
+        upper = min(num_tuples, estimate * ratio)
+
+        return round(estimate), (
+            "sampled "
+            + format(percent, ".3g")
+            + "% of relation, true value between "
+            + str(round(lower))
+            + " and "
+            + str(round(upper))
+        )
+
 
 #################### NODE SUBCLASSES ######################
 
@@ -584,6 +3440,8 @@ class MyNode(Node):
     Testing node. Will print all of B(), T(), V() and M
     """
 
+    __slots__ = ()
+
     def define_explanations(self):
         self.str_explain_formula = "Formula: B(rel) + T(rel) + V(rel, attr) + M"
         self.str_explain_difference = "Some explanation for difference"
@@ -612,6 +3470,25 @@ class ScanNodes(Node):
     Helper class that contains utility functions for most scan-related nodes
     """
 
+    __slots__ = ()
+
+    def stats_requests(self):
+        requests = super().stats_requests()
+        if not requests:
+            return requests
+
+        # Attributes compared in the filter or index condition
+        rel = requests[0][0]
+        for i in range(self.count_conditions()):
+            try:
+                attr = self.retrieve_attribute_from_condition(i)
+            except ValueError:
+                # Condition without a comparison operator
+                continue
+            if attr:
+                requests.append((rel, attr))
+        return requests
+
     def cardinality(self, is_tuple):
         """
         Estimate number of filtered tuple resulting from this query node
@@ -759,6 +3636,8 @@ class ScanNodes(Node):
 
 
 class SeqScanNode(ScanNodes):
+    __slots__ = ()
+
     def define_explanations(self):
         self.str_explain_formula = ""
         self.str_explain_difference = ""
@@ -777,6 +3656,18 @@ class SeqScanNode(ScanNodes):
             src="difference",
             tgt="PostgreSQL factors in parallel processing and CPU cost into the calculation",
         )
+        self.append(
+            src="difference",
+            tgt="PostgreSQL Cost Formula: seq_page_cost ("
+            + str(self.setting("seq_page_cost"))
+            + ") * B("
+            + rel
+            + ") + cpu_tuple_cost ("
+            + str(self.setting("cpu_tuple_cost"))
+            + ") * T("
+            + rel
+            + ")",
+        )
 
     def manual_cost(self):
         rel = self.node_json["Relation Name"] if "Relation Name" in self.node_json else "nation"
@@ -794,6 +3685,8 @@ class SeqScanNode(ScanNodes):
 
 
 class IndexScanNode(ScanNodes):
+    __slots__ = ()
+
     def define_explanations(self):
         self.str_explain_formula = ""
         self.str_explain_difference = ""
@@ -815,6 +3708,14 @@ class IndexScanNode(ScanNodes):
             src="difference",
             tgt="PostgreSQL uses the more accurate Market and Lohman approximation to estimate number of pages fetched.",
         )
+        self.append(
+            src="difference",
+            tgt="Each page fetched out of order costs random_page_cost ("
+            + str(self.setting("random_page_cost"))
+            + ") instead of seq_page_cost ("
+            + str(self.setting("seq_page_cost"))
+            + ").",
+        )
         self.append(
             src="difference",
             tgt="Also, PostgreSQL uses optimizations such as parallel processing and caching.",
@@ -842,6 +3743,8 @@ class IndexScanNode(ScanNodes):
 
 
 class IndexOnlyScanNode(ScanNodes):
+    __slots__ = ()
+
     def define_explanations(self):
         self.str_explain_formula = ""
         self.str_explain_difference = ""
@@ -881,6 +3784,8 @@ class IndexOnlyScanNode(ScanNodes):
 
 
 class BitmapIndexScanNode(Node):
+    __slots__ = ()
+
     def define_explanations(self):
         self.str_explain_formula = ""
         self.str_explain_difference = ""
@@ -908,6 +3813,8 @@ class BitmapIndexScanNode(Node):
 
 
 class BitmapHeapScanNode(ScanNodes):
+    __slots__ = ()
+
     def define_explanations(self):
         self.str_explain_formula = ""
         self.str_explain_difference = ""
@@ -950,6 +3857,8 @@ class BitmapHeapScanNode(ScanNodes):
 
 
 class BitmapAndNode(Node):
+    __slots__ = ()
+
     def define_explanations(self):
         self.str_explain_formula = "AND operation on bit arrays are negligible"
         self.str_explain_difference = (
@@ -960,17 +3869,11 @@ class BitmapAndNode(Node):
         return 0
 
     def build_parent_dict(self):
-        rel = self.node_json["Relation Name"]
-
-        # Treat this as an intersect operator unless there is more time
+        # Treat this as an intersect operator of all children unless there is more time
         parent_dict = {
             "Node Type": self.node_json["Node Type"],
-            "block_size": min(
-                self.node_json["Left block_size"], self.node_json["Right block_size"]
-            ),
-            "tuple_size": min(
-                self.node_json["Left tuple_size"], self.node_json["Right tuple_size"]
-            ),
+            "block_size": min(child.parent_dict["block_size"] for child in self.children),
+            "tuple_size": min(child.parent_dict["tuple_size"] for child in self.children),
             "manual_cost": 0,
             "postgre_cost": self.node_json["Total Cost"],
         }
@@ -979,6 +3882,8 @@ class BitmapAndNode(Node):
 
 
 class BitmapOrNode(Node):
+    __slots__ = ()
+
     def define_explanations(self):
         self.str_explain_formula = "OR operation on bit arrays are negligible"
         self.str_explain_difference = """PostgreSQL factors in overhead of bitmap access into cost calculation
@@ -988,15 +3893,11 @@ class BitmapOrNode(Node):
         return 0
 
     def build_parent_dict(self):
-        rel = self.node_json["Relation Name"]
-
-        # Treat this as a union operator unless there is more time
+        # Treat this as a union operator of all children unless there is more time
         parent_dict = {
             "Node Type": self.node_json["Node Type"],
-            "block_size": self.node_json["Left block_size"]
-            + self.node_json["Right block_size"],
-            "tuple_size": self.node_json["Left tuple_size"]
-            + self.node_json["Right tuple_size"],
+            "block_size": self.sum_children("block_size"),
+            "tuple_size": self.sum_children("tuple_size"),
             "manual_cost": 0,
             "postgre_cost": self.node_json["Total Cost"],
         }
@@ -1009,7 +3910,7 @@ class CTEScanNode(SeqScanNode):
     CTE Scan is very similar to sequential scan, but for WITH operations
     """
 
-    pass
+    __slots__ = ()
 
 
 class SubqueryScanNode(SeqScanNode):
@@ -1017,10 +3918,12 @@ class SubqueryScanNode(SeqScanNode):
     Subquery Scan is very similar to sequential scan, but for nested SELECT operations
     """
 
-    pass
+    __slots__ = ()
 
 
 class AppendNode(Node):
+    __slots__ = ()
+
     def define_explanations(self):
         self.str_explain_formula = ""
         self.str_explain_difference = ""
@@ -1036,35 +3939,24 @@ class AppendNode(Node):
         )
 
     def manual_cost(self):
-        total_cost = self.node_json["Left manual_cost"]
-        if self.right is not None:
-            total_cost += self.node_json["Right manual_cost"]
-
-        return total_cost
+        return self.sum_children("manual_cost")
 
     def build_parent_dict(self):
 
         parent_dict = {
             "Node Type": self.node_json["Node Type"],
-            "block_size": self.node_json["Left block_size"],
-            "tuple_size": self.node_json["Left tuple_size"],
+            "block_size": self.sum_children("block_size"),
+            "tuple_size": self.sum_children("tuple_size"),
             "manual_cost": self.manual_cost(),
             "postgre_cost": self.node_json["Total Cost"],
         }
 
-        # Conditional addition of block_size
-        if self.right is not None:
-            parent_dict["block_size"] = (
-                self.node_json["Left block_size"] + self.node_json["Right block_size"]
-            )
-            parent_dict["tuple_size"] = (
-                self.node_json["Left tuple_size"] + self.node_json["Right tuple_size"]
-            )
-
         return parent_dict
 
 
 class MergeAppendNode(Node):
+    __slots__ = ()
+
     def define_explanations(self):
         self.str_explain_formula = ""
         self.str_explain_difference = ""
@@ -1086,15 +3978,11 @@ class MergeAppendNode(Node):
         )
 
     def manual_cost(self):
-        total_cost = self.node_json["Left manual_cost"]
-        if self.right is not None:
-            total_cost += self.node_json["Right manual_cost"]
+        total_cost = self.sum_children("manual_cost")
 
         # Merge cost might be proportional to the total number of rows across all children
         # Assuming a linear merge cost model here
-        merge_cost = self.node_json["Left tuple_size"]
-        if self.right is not None:
-            merge_cost += self.node_json["Right tuple_size"]
+        merge_cost = self.sum_children("tuple_size")
 
         total_cost += merge_cost
 
@@ -1104,25 +3992,18 @@ class MergeAppendNode(Node):
 
         parent_dict = {
             "Node Type": self.node_json["Node Type"],
-            "block_size": self.node_json["Left block_size"],
-            "tuple_size": self.node_json["Left tuple_size"],
+            "block_size": self.sum_children("block_size"),
+            "tuple_size": self.sum_children("tuple_size"),
             "manual_cost": self.manual_cost(),
             "postgre_cost": self.node_json["Total Cost"],
         }
 
-        # Conditional addition of block_size
-        if self.right is not None:
-            parent_dict["block_size"] = (
-                self.node_json["Left block_size"] + self.node_json["Right block_size"]
-            )
-            parent_dict["tuple_size"] = (
-                self.node_json["Left tuple_size"] + self.node_json["Right tuple_size"]
-            )
-
         return parent_dict
 
 
 class NestedLoopJoinNode(Node):
+    __slots__ = ()
+
     def define_explanations(self):
         self.str_explain_formula = ""
         self.str_explain_difference = ""
@@ -1183,6 +4064,8 @@ class NestedLoopJoinNode(Node):
 
 
 class MergeJoinNode(Node):
+    __slots__ = ()
+
     def define_explanations(self):
         self.str_explain_formula = ""
         self.str_explain_difference = ""
@@ -1231,6 +4114,8 @@ class MergeJoinNode(Node):
 
 
 class HashNode(Node):
+    __slots__ = ()
+
     def define_explanations(self):
         self.str_explain_formula = ""
         self.str_explain_difference = ""
@@ -1275,6 +4160,8 @@ class HashNode(Node):
 
 
 class HashJoinNode(Node):
+    __slots__ = ()
+
     def define_explanations(self):
         self.str_explain_formula = ""
         self.str_explain_difference = ""
@@ -1334,6 +4221,8 @@ class HashJoinNode(Node):
 
 
 class GatherNode(Node):  # formula unsure
+    __slots__ = ()
+
     def define_explanations(self):
         self.str_explain_formula = ""
         self.str_explain_difference = ""
@@ -1352,35 +4241,24 @@ class GatherNode(Node):  # formula unsure
         )
 
     def manual_cost(self):
-        total_cost = self.node_json["Left manual_cost"]
-        if self.right is not None:
-            total_cost += self.node_json["Right manual_cost"]
-
-        return total_cost
+        return self.sum_children("manual_cost")
 
     def build_parent_dict(self):
 
         parent_dict = {
             "Node Type": self.node_json["Node Type"],
-            "block_size": self.node_json["Left block_size"],
-            "tuple_size": self.node_json["Left tuple_size"],
+            "block_size": self.sum_children("block_size"),
+            "tuple_size": self.sum_children("tuple_size"),
             "manual_cost": self.manual_cost(),
             "postgre_cost": self.node_json["Total Cost"],
         }
 
-        # Conditional addition of block_size
-        if self.right is not None:
-            parent_dict["block_size"] = (
-                self.node_json["Left block_size"] + self.node_json["Right block_size"]
-            )
-            parent_dict["tuple_size"] = (
-                self.node_json["Left tuple_size"] + self.node_json["Right tuple_size"]
-            )
-
         return parent_dict
 
 
 class GatherMergeNode(Node):  # formula unsure
+    __slots__ = ()
+
     def define_explanations(self):
         self.str_explain_formula = ""
         self.str_explain_difference = ""
@@ -1402,15 +4280,11 @@ class GatherMergeNode(Node):  # formula unsure
         )
 
     def manual_cost(self):
-        total_cost = self.node_json["Left manual_cost"]
-        if self.right is not None:
-            total_cost += self.node_json["Right manual_cost"]
+        total_cost = self.sum_children("manual_cost")
 
         # Merge cost might be proportional to the total number of rows across all children
         # Assuming a linear merge cost model here
-        merge_cost = self.node_json["Left tuple_size"]
-        if self.right is not None:
-            merge_cost += self.node_json["Right tuple_size"]
+        merge_cost = self.sum_children("tuple_size")
 
         total_cost += merge_cost
 
@@ -1420,21 +4294,18 @@ class GatherMergeNode(Node):  # formula unsure
 
         parent_dict = {
             "Node Type": self.node_json["Node Type"],
-            "block_size": self.node_json["Left block_size"],
-            "tuple_size": self.node_json["Left tuple_size"],
+            "block_size": self.sum_children("block_size"),
+            "tuple_size": self.sum_children("tuple_size"),
             "manual_cost": self.manual_cost(),
             "postgre_cost": self.node_json["Total Cost"],
         }
 
-        # Conditional addition of block_size
-        if self.right is not None:
-            parent_dict["block_size"] = self.node_json["Left block_size"] + self.node_json["Right block_size"]
-            parent_dict["tuple_size"] = self.node_json["Left tuple_size"] + self.node_json["Right tuple_size"]
-
         return parent_dict
 
 
 class SortGroupNodes(Node):
+    __slots__ = ()
+
     def extract_relation_name(self):
         """
         Retrieve the name of the relation from node_json["Sort Key"] or node_json["Group Key"]
@@ -1457,6 +4328,9 @@ class SortGroupNodes(Node):
         # Return a random relation for the time being
         return "nation" 
 
+    def stats_requests(self):
+        return [(self.extract_relation_name(), None)]
+
     def build_parent_dict(self):
         rel = self.extract_relation_name()
         parent_dict = {
@@ -1471,24 +4345,55 @@ class SortGroupNodes(Node):
 
 
 class SortNode(SortGroupNodes):
+    __slots__ = ()
+
+    # Bytes in each unit of a memory setting in pg_settings
+    MEMORY_UNITS = {"B": 1, "kB": 1024, "8kB": 8192, "MB": 1024**2, "GB": 1024**3, "TB": 1024**4}
+
+    def sort_method(self):
+        """
+        EXPLAIN only reports the Sort Method when the query was executed.
+        Without ANALYZE, e.g. ESTIMATE_ONLY or GENERIC_PLAN, it is predicted
+        like the planner does: quicksort if Plan width * T(R) fits in work_mem
+
+        @return: The Sort Method of this node
+        """
+        method = self.node_json.get("Sort Method")
+        if method is not None:
+            return method
+
+        rel = self.extract_relation_name()
+        sorted_bytes = self.node_json.get("Plan Width", 0) * self.T(rel, False)
+        work_mem = self.setting("work_mem") * self.MEMORY_UNITS.get(self.setting("work_mem_unit"), 1024)
+        if sorted_bytes <= work_mem:
+            return "quicksort"
+        return "external merge"
+
     def define_explanations(self):
         self.str_explain_formula = ""
         self.str_explain_difference = ""
         # explain relation and attributes
 
-        if self.node_json["Sort Method"] == "external merge":
+        method = self.sort_method()
+        if "Sort Method" not in self.node_json:
+            self.append(
+                src="formula",
+                tgt="The Sort Method is only known under ANALYZE, " + method + " is predicted from work_mem",
+            )
+
+        if method == "external merge":
             self.append(src="formula", tgt="Mergesort Formula : 3 * B(rel)")
             self.append(
                 src="formula",
                 tgt="Mergesort is used when data does not fit in memory(work_mem)",
             )
-            self.append(src="formula", tgt="Plan width * T(R) > work_mem")
+            self.append(src="formula", tgt="Plan width * T(R) > work_mem" + self.work_mem())
             self.append(
                 src="difference",
                 tgt="PostgreSQL includes default cost per comparison costs and overhead per extracted tuple",
             )
 
-        elif self.node_json["Sort Method"] == "quicksort":
+        elif method == "quicksort":
             self.append(
                 src="formula",
                 tgt="Quicksort Formula : B(rel). This is the default algorithm",
@@ -1497,13 +4402,13 @@ class SortNode(SortGroupNodes):
                 src="formula",
                 tgt="Quicksort is used when entire data fits into memory(work_mem) -- One pass.",
             )
-            self.append(src="formula", tgt="Plan width * T(R) < work_mem")
+            self.append(src="formula", tgt="Plan width * T(R) < work_mem" + self.work_mem())
             self.append(
                 src="difference",
                 tgt="PostgreSQL includes default cost per comparison costs and overhead per extracted tuple",
             )
 
-        elif self.node_json["Sort Method"] == "top-N heapsort":
+        elif method == "top-N heapsort":
             self.append(src="formula", tgt="Top-N heapsort Formula : B(rel) / 3.")
             self.append(
                 src="formula",
@@ -1514,20 +4419,35 @@ class SortNode(SortGroupNodes):
                 tgt="PostgreSQL includes default cost per comparison costs and overhead per extracted tuple, as well as cost to maintain heap of the top N items.",
             )
 
+    def work_mem(self):
+        """
+        @return: The session's work_mem, formatted to follow the formula
+        """
+        return (
+            " ("
+            + str(self.setting("work_mem"))
+            + " "
+            + self.setting("work_mem_unit")
+            + ")"
+        )
+
     def manual_cost(self):
         rel = super().extract_relation_name()
-        if self.node_json["Sort Method"] == "external merge":
+        method = self.sort_method()
+        if method == "external merge":
             return self.B(rel) * 3
 
-        elif self.node_json["Sort Method"] == "quicksort":
-            return self.B(rel)
-
-        elif self.node_json["Sort Method"] == "top-N heapsort":
+        elif method == "top-N heapsort":
             # Not sure about topn cost
             return self.B(rel) / 3
 
+        # quicksort, and the methods of a sort that did not finish
+        return self.B(rel)
+
 
 class IncrementalSortNode(SortGroupNodes):
+    __slots__ = ()
+
     def define_explanations(self):
         self.str_explain_formula = ""
         self.str_explain_difference = ""
@@ -1553,6 +4473,8 @@ class IncrementalSortNode(SortGroupNodes):
 
 
 class LimitNode(Node):
+    __slots__ = ()
+
     def define_explanations(self):
         # explain relation and attributes
         self.str_explain_formula = "Takes some rows and discards remaining ones "
@@ -1575,6 +4497,8 @@ class LimitNode(Node):
 
 
 class MaterializeNode(Node):
+    __slots__ = ()
+
     def define_explanations(self):
         self.str_explain_formula = ""
         self.str_explain_difference = ""
@@ -1614,6 +4538,8 @@ class MaterializeNode(Node):
 
 
 class MemoizeNode(Node):
+    __slots__ = ()
+
     def define_explanations(self):
         self.str_explain_formula = ""
         self.str_explain_difference = ""
@@ -1651,6 +4577,8 @@ class MemoizeNode(Node):
 
 
 class GroupNode(SortGroupNodes):
+    __slots__ = ()
+
     def define_explanations(self):
         self.str_explain_formula = "Formula : T(rel) * Number of Group Columns. "
         self.str_explain_difference = """PostgreSQL includes default cost per comparison costs overhead per input tuple.  """
@@ -1662,6 +4590,8 @@ class GroupNode(SortGroupNodes):
 
 
 class AggregateNode(Node):
+    __slots__ = ()
+
     def define_explanations(self):
         self.str_explain_formula = ""
         self.str_explain_difference = ""
@@ -1704,6 +4634,8 @@ class AggregateNode(Node):
 
 
 class UniqueNode(Node):
+    __slots__ = ()
+
     def define_explanations(self):
         self.str_explain_formula = ""
         self.str_explain_difference = ""
@@ -1,9 +1,12 @@
 from PyQt6 import QtCore, QtGui, QtWidgets
-from PyQt6.QtWidgets import QMainWindow, QWidget, QHBoxLayout, QVBoxLayout, QPushButton, QTextEdit, QLabel, QComboBox, QTreeWidgetItem, QTreeWidget
-from PyQt6.QtCore import Qt
+from PyQt6.QtWidgets import QMainWindow, QWidget, QHBoxLayout, QVBoxLayout, QPushButton, QTextEdit, QLabel, QComboBox, QTreeWidgetItem, QTreeWidget, QCheckBox, QSpinBox
+from PyQt6.QtCore import Qt, QObject, QRunnable, QThreadPool, pyqtSignal
 import json
 
-from explain import QueryDetails, LoginDetails, retrieve_query, load_qep_explanations, initialize_tree
+from explain import QueryDetails, LoginDetails, EXPLAIN_ANALYZE, LOW_OVERHEAD, FULL_DIAGNOSTICS, ESTIMATE_ONLY, GENERIC_PLAN, QueryCancelled, QueryHandle, retrieve_plan, stream_qep_explanations, initialize_tree
+
+# Threads used by parallel explanations. Each holds a pooled connection while it runs
+PARALLEL_WORKERS = 4
 
 class LoginWidget(object):
     def __init__(self, login_details):
@@ -110,10 +113,121 @@ class LoginWidget(object):
         self.loginButton.clicked.connect(loginWidget.close)
 
     def onClickLogin(self):
-        self.login_details.host = self.hostInput.text()
-        self.login_details.port = self.portInput.text()
-        self.login_details.user = self.userInput.text()
-        self.login_details.password = self.passwordInput.text()
+        self.login_details = LoginDetails(
+            host=self.hostInput.text(),
+            port=self.portInput.text(),
+            user=self.userInput.text(),
+            password=self.passwordInput.text(),
+        )
+
+class WorkerSignals(QObject):
+    """
+    Signals emitted by ExplainWorker. QRunnable is not a QObject,
+    so the signals live on this separate object.
+    """
+
+    progress = pyqtSignal(str)
+    tree_ready = pyqtSignal(object)
+    chunk = pyqtSignal(str)
+    result = pyqtSignal(object, str)
+    error = pyqtSignal(str)
+    cancelled = pyqtSignal(str)
+    finished = pyqtSignal()
+
+
+class ExplainWorker(QRunnable):
+    """
+    Runs EXPLAIN ANALYZE, builds the query plan tree and explains every node
+    on a thread pool thread, so that the GUI thread never blocks on the database.
+    Results are delivered back to the GUI thread through self.signals.
+    """
+
+    def __init__(self, login_details, query_details, exact_counts=False, statement_timeout=None, options=EXPLAIN_ANALYZE, refresh=False, lazy=False, max_workers=1):
+        super().__init__()
+        self.refresh = refresh
+        self.lazy = lazy
+        self.max_workers = max_workers
+        self.login_details = login_details
+        self.query_details = query_details
+        self.exact_counts = exact_counts
+        self.statement_timeout = statement_timeout
+        self.options = options
+        self.handle = QueryHandle()
+        self.signals = WorkerSignals()
+
+    def cancel(self):
+        """
+        Cancel the running query on the server. Safe to call from the GUI thread
+        """
+        self.handle.cancel()
+
+    def run(self):
+        try:
+            self.signals.progress.emit("Running " + self.options.to_sql() + "...")
+            qep, cached_at = retrieve_plan(self.login_details, self.query_details, self.options, self.statement_timeout, self.handle, self.refresh)
+            if not qep:
+                self.signals.error.emit("Failed to retrieve the query execution plan")
+                return
+
+            # Mark results served from the plan cache
+            summary = dict(qep[0][0][0])
+            if cached_at is not None:
+                summary["Cached At"] = cached_at
+
+            self.handle.check()
+            self.signals.progress.emit("Building query plan tree...")
+            tree = initialize_tree(qep[0][0][0]['Plan'], self.login_details, self.query_details, self.exact_counts, self.options, summary, self.max_workers)
+            self.signals.tree_ready.emit(tree)
+
+            # Lazy mode explains the nodes one at a time when they are selected
+            if self.lazy:
+                tree.close()
+                self.signals.result.emit(tree, tree.explain_summary())
+                return
+
+            # Return the tree's pooled connection even if the request is cancelled midway
+            with tree:
+                self.handle.check()
+                self.signals.progress.emit("Explaining query plan...")
+
+                # Send the explanation of every node as soon as it is ready
+                chunks = []
+                for chunk in stream_qep_explanations(tree):
+                    self.handle.check()
+                    chunks.append(chunk)
+                    self.signals.chunk.emit(chunk)
+            self.signals.result.emit(tree, "".join(chunks).strip())
+        except QueryCancelled as e:
+            self.signals.cancelled.emit(str(e))
+        except Exception as e:
+            self.signals.error.emit(str(e))
+        finally:
+            self.signals.finished.emit()
+
+
+class NodeWorkerSignals(QObject):
+    result = pyqtSignal(object, object, str)
+    error = pyqtSignal(str)
+
+
+class NodeExplainWorker(QRunnable):
+    """
+    Explains a single node of a tree in lazy mode, off the GUI thread
+    """
+
+    def __init__(self, tree, node):
+        super().__init__()
+        self.tree = tree
+        self.node = node
+        self.signals = NodeWorkerSignals()
+
+    def run(self):
+        try:
+            output = self.tree.explain_node_lazily(self.node)
+            self.signals.result.emit(self.tree, self.node, output)
+        except Exception as e:
+            self.signals.error.emit(str(e))
+
 
 class MainUI(QMainWindow):
     def __init__(self, login_details, db_list):
@@ -123,6 +237,16 @@ class MainUI(QMainWindow):
         self.tree_widget = None #  QTree instance
         self.qep_tree = None # Tree instance
 
+        # Database work runs on this pool, off the GUI thread
+        self.thread_pool = QThreadPool()
+        self.current_worker = None # Worker whose results are displayed
+
+        # Lazy node explanations share the tree's session, so run them one at a time
+        self.node_pool = QThreadPool()
+        self.node_pool.setMaxThreadCount(1)
+        self.qep_lazy = False # Whether self.qep_tree is explained lazily
+        self.qep_summary = "" # Query summary shown above lazy explanations
+
         self.setWindowTitle("SQL Query Executor")
         self.resize(1350, 882)
         self.setStyleSheet("background-color: #ffffff;")
@@ -158,9 +282,56 @@ class MainUI(QMainWindow):
         left_layout.addWidget(self.sql_input)
         self.sql_input.setPlainText("SELECT * FROM region LEFT JOIN nation on region.r_regionkey = nation.n_regionkey WHERE n_regionkey = 1 ORDER BY r_name DESC")
 
+        # Explain mode. Only the ANALYZE modes execute the query
+        self.explain_modes = [
+            ("EXPLAIN ANALYZE (executes the query)", EXPLAIN_ANALYZE),
+            ("Low overhead ANALYZE, TIMING OFF (executes the query)", LOW_OVERHEAD),
+            ("Full diagnostics ANALYZE (executes the query)", FULL_DIAGNOSTICS),
+            ("Estimate only (does not execute the query)", ESTIMATE_ONLY),
+            ("Generic plan (parameterized SQL, PostgreSQL 16+)", GENERIC_PLAN),
+        ]
+        self.mode_selector = QComboBox()
+        self.mode_selector.addItems([label for label, _ in self.explain_modes])
+        left_layout.addWidget(self.mode_selector)
+
+        # Opt-in exact statistics, which scan the whole relation instead of reading the catalog
+        self.exact_counts_checkbox = QCheckBox("Exact counts (scans every relation, slow)")
+        left_layout.addWidget(self.exact_counts_checkbox)
+
+        # Only explain the nodes selected in the QEP tree
+        self.lazy_checkbox = QCheckBox("Lazy explanations (explain a node when it is selected)")
+        left_layout.addWidget(self.lazy_checkbox)
+
+        # Explain the independent subtrees of the plan on several connections at once
+        self.parallel_checkbox = QCheckBox("Parallel explanations (explain subtrees concurrently)")
+        left_layout.addWidget(self.parallel_checkbox)
+
+        # Re-run the query even if the same query was explained before
+        self.refresh_checkbox = QCheckBox("Force refresh (ignore cached plan)")
+        left_layout.addWidget(self.refresh_checkbox)
+
         # Execute Query Button
         self.execute_button = QPushButton("Execute Query")
         left_layout.addWidget(self.execute_button)
+
+        # Cancel Button for the query currently running
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.setEnabled(False)
+        left_layout.addWidget(self.cancel_button)
+
+        # Statement timeout in seconds, 0 means no limit
+        timeout_layout = QHBoxLayout()
+        timeout_layout.addWidget(QLabel("Statement timeout (s):"))
+        self.timeout_input = QSpinBox()
+        self.timeout_input.setRange(0, 86400)
+        self.timeout_input.setValue(300)
+        self.timeout_input.setSpecialValueText("None")
+        timeout_layout.addWidget(self.timeout_input)
+        left_layout.addLayout(timeout_layout)
+
+        # Progress of the query currently being explained
+        self.status_label = QLabel("")
+        left_layout.addWidget(self.status_label)
         
         # Container for left layout
         left_widget = QWidget()
@@ -179,6 +350,8 @@ class MainUI(QMainWindow):
         
         self.tree_widget = QTreeWidget()
         self.tree_widget.setHeaderLabels(["Node Type", "Total Cost"])
+        self.tree_widget.itemSelectionChanged.connect(self.on_tree_selection_changed)
+        self.tree_widget.itemExpanded.connect(self.explain_tree_item)
         right_layout.addWidget(self.tree_widget)
      
         # Add right layout to a container widget and then to the main layout
@@ -188,16 +361,66 @@ class MainUI(QMainWindow):
 
         # Connect the button click to a method (to be implemented)
         self.execute_button.clicked.connect(lambda: self.execute_query(self.database_selector.currentText(), self.sql_input.toPlainText()))
+        self.cancel_button.clicked.connect(self.cancel_query)
 
     def execute_query(self, database_name, query):
         self.tree_widget.clear()
-        query_details = QueryDetails
-        query_details.database = database_name
-        query_details.query = query
-        qep = retrieve_query(self.login_details, query_details)
-        # self.query_output.setText(json.dumps(qep[0][0][0], indent=4))
-
-        self.qep_tree = initialize_tree(qep[0][0][0]['Plan'], self.login_details, query_details)
+        self.query_output.clear()
+        query_details = QueryDetails(database=database_name, query=query)
+
+        # A new execution supersedes the previous one
+        self.cancel_query()
+
+        # Run the query and the explanation on the thread pool
+        statement_timeout = self.timeout_input.value() * 1000 or None
+        options = self.explain_modes[self.mode_selector.currentIndex()][1]
+        worker = ExplainWorker(self.login_details, query_details, self.exact_counts_checkbox.isChecked(), statement_timeout, options, self.refresh_checkbox.isChecked(), self.lazy_checkbox.isChecked(), PARALLEL_WORKERS if self.parallel_checkbox.isChecked() else 1)
+        worker.signals.progress.connect(lambda message: self.on_explain_progress(worker, message))
+        worker.signals.tree_ready.connect(lambda tree: self.on_tree_ready(worker, tree))
+        worker.signals.chunk.connect(lambda chunk: self.on_explain_chunk(worker, chunk))
+        worker.signals.result.connect(lambda tree, explanations: self.on_explain_result(worker, tree, explanations))
+        worker.signals.error.connect(lambda message: self.on_explain_error(worker, message))
+        worker.signals.cancelled.connect(lambda message: self.on_explain_cancelled(worker, message))
+        self.current_worker = worker
+        self.cancel_button.setEnabled(True)
+        self.thread_pool.start(worker)
+
+    def cancel_query(self):
+        if self.current_worker is not None:
+            self.current_worker.cancel()
+            self.current_worker = None
+            self.cancel_button.setEnabled(False)
+            self.status_label.setText("Query cancelled")
+
+    def on_explain_cancelled(self, worker, message):
+        # Cancellations requested through cancel_query were already reported
+        if worker is self.current_worker:
+            self.current_worker = None
+            self.cancel_button.setEnabled(False)
+            self.status_label.setText(message)
+
+    def on_explain_progress(self, worker, message):
+        # Ignore workers that were superseded by a newer execution
+        if worker is self.current_worker:
+            self.status_label.setText(message)
+
+    def on_explain_error(self, worker, message):
+        if worker is self.current_worker:
+            self.status_label.setText("")
+            self.current_worker = None
+            self.cancel_button.setEnabled(False)
+            from project import Main
+
+            Main.show_error(message)
+
+    def on_tree_ready(self, worker, tree):
+        """
+        Show the structure of the plan before any node is explained
+        """
+        if worker is not self.current_worker:
+            return
+        self.qep_tree = tree
+        self.qep_lazy = worker.lazy
 
         self.populate_tree_widget(self.qep_tree)
         
@@ -205,27 +428,91 @@ class MainUI(QMainWindow):
         self.tree_widget.setColumnWidth(0,200)
         self.tree_widget.setColumnWidth(1,100)
 
-        # Append explanations into output field
         self.query_output.clear()
-        explanations = load_qep_explanations(self.qep_tree)
-        self.append_query_output(explanations)
-        
+        if not self.qep_lazy:
+            self.query_output.append("\n--------------------------------------------")
+
+    def on_explain_chunk(self, worker, chunk):
+        # Render the explanation of each node as soon as it is ready
+        if worker is self.current_worker:
+            self.append_query_chunk(chunk)
+
+    def on_explain_result(self, worker, tree, explanations):
+        if worker is not self.current_worker:
+            return
+        self.current_worker = None
+        self.cancel_button.setEnabled(False)
+        self.status_label.setText("")
+
+        if self.qep_lazy:
+            self.qep_summary = explanations
+            self.query_output.setPlaceholderText("Select a node in the QEP tree to explain it...")
+            if explanations:
+                self.append_query_output(explanations)
+            return
+
+        # The explanations were already streamed into the output field
+        self.query_output.append("----------------------------------------------")
+
+    def on_tree_selection_changed(self):
+        items = self.tree_widget.selectedItems()
+        if items:
+            self.explain_tree_item(items[0])
+
+    def explain_tree_item(self, item):
+        """
+        In lazy mode, explain the node of a QEP tree item on the node pool
+        """
+        if not self.qep_lazy:
+            return
+        node = item.data(0, Qt.ItemDataRole.UserRole)
+        worker = NodeExplainWorker(self.qep_tree, node)
+        worker.signals.result.connect(self.on_node_explained)
+        worker.signals.error.connect(self.status_label.setText)
+        self.status_label.setText("Explaining node #" + str(node.id) + "...")
+        self.node_pool.start(worker)
+
+    def on_node_explained(self, tree, node, output):
+        # Ignore results of a previous tree, or of a node that is no longer selected
+        if tree is not self.qep_tree:
+            return
+        self.status_label.setText("")
+        items = self.tree_widget.selectedItems()
+        if items and items[0].data(0, Qt.ItemDataRole.UserRole) is not node:
+            return
+        self.query_output.clear()
+        if self.qep_summary:
+            self.append_query_output(self.qep_summary)
+        self.append_query_output(output)
+
+    def append_query_chunk(self, chunk):
+        # Insert at the end without starting a new paragraph for every chunk
+        cursor = self.query_output.textCursor()
+        cursor.movePosition(QtGui.QTextCursor.MoveOperation.End)
+        cursor.insertText(chunk)
+
     def append_query_output(self, textual_query):
         self.query_output.append("\n--------------------------------------------")
         self.query_output.append(textual_query)
         self.query_output.append("----------------------------------------------")
 
-    def build_tree_recursive(self, node, parent_widget):
-        if node is not None:
-            tree_item = QTreeWidgetItem(parent_widget, [f"{node.id}. {node.node_json['Node Type']}", str(node.node_json["Total Cost"])])
-            self.build_tree_recursive(node.left, tree_item)        
-            self.build_tree_recursive(node.right, tree_item)
+    def create_tree_item(self, node):
+        tree_item = QTreeWidgetItem([f"{node.id}. {node.node_json['Node Type']}", str(node.node_json["Total Cost"])])
+        tree_item.setData(0, Qt.ItemDataRole.UserRole, node)
+        return tree_item
 
     def populate_tree_widget(self, tree):
-        root = tree.root
-        tree_item = QTreeWidgetItem(self.tree_widget, [f"{root.id}. {root.node_json['Node Type']}", str(tree.root.node_json["Total Cost"])])
-        self.build_tree_recursive(tree.root.left, tree_item)
-        self.build_tree_recursive(tree.root.right, tree_item)
+        root_item = self.create_tree_item(tree.root)
+        self.tree_widget.addTopLevelItem(root_item)
+
+        # Explicit stack instead of recursion, plans can be nested very deeply
+        stack = [(tree.root, root_item)]
+        while stack:
+            node, tree_item = stack.pop()
+            # Add the items of all children at once, an Append can have thousands
+            child_items = [self.create_tree_item(child) for child in node.children]
+            tree_item.addChildren(child_items)
+            stack.extend(zip(node.children, child_items))
 
 class ErrorDialog(QtWidgets.QDialog):
     def __init__(self, message, parent=None):
@@ -1,17 +1,19 @@
+import os
 import sys
 from PyQt6 import QtWidgets
 from interface import LoginWidget, ErrorDialog, MainUI
-from explain import get_database_names, check_connection, LoginDetails, QueryDetails
+from explain import get_database_names, check_connection, close_all_pools, plan_cache, LoginDetails, QueryDetails
 
 
 class Main:
     def __init__(self):
         self.app = QtWidgets.QApplication(sys.argv)
-        self.login_details = LoginDetails
-        self.login_details.host = "localhost"
-        self.login_details.port = "5432"
-        self.login_details.user = "postgres"
-        self.login_details.password = "no_password"
+        self.login_details = LoginDetails(
+            host="localhost",
+            port="5432",
+            user="postgres",
+            password="no_password",
+        )
         self.login_details = (
             self.login()
         )  # Call login window, get user login_details on connect.
@@ -28,6 +30,8 @@ class Main:
             loginpage.show()
             self.app.exec()  # Use the QApplication instance created in __init__
 
+            # Show what the user entered again if the login fails
+            self.login_details = login_ui.login_details
             if not check_connection(login_ui.login_details):
                 continue
             else:
@@ -42,6 +46,10 @@ class Main:
    
 
     def main(self):
+        # Keep explained plans across restarts
+        plan_cache.path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "plan_cache.json")
+        plan_cache.load()
+
         db_list = get_database_names(
             self.login_details
         )  # Function returns list of database names
@@ -54,6 +62,12 @@ class Main:
         main_ui.show()
         self.app.exec()
 
+        # Release every pooled database connection before exiting
+        close_all_pools()
+
+        # put() only saves the plan cache every few seconds
+        plan_cache.save()
+
     # Standard error static method to be called throughout the 3 files
     @staticmethod
     def show_error(msg):
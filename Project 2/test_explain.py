@@ -0,0 +1,693 @@
+"""
+Tests of explain.py that do not need a database. Run with
+
+    python -m unittest test_explain
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import psycopg2
+import psycopg2.extensions
+
+from explain import (
+    ESTIMATE_ONLY,
+    EXPLAIN_ANALYZE,
+    MAX_SAMPLE_PERCENT,
+    ConnectionPool,
+    LoginDetails,
+    PlanCache,
+    QueryDetails,
+    check_connection,
+    check_connection_async,
+    close_all_pools,
+    explain_async,
+    explanation_cache,
+    get_database_names,
+    get_database_names_async,
+    initialize_tree,
+    load_qep_explanations,
+    normalize_query,
+    retrieve_plan,
+    retrieve_query,
+    sample_percent,
+    stats_cache,
+    stats_database,
+    subtree_cache,
+)
+
+LOGIN = LoginDetails(host="localhost", port=5432, user="postgres", password="")
+
+# pg_settings rows of the fake server, as (name, setting, unit, vartype)
+SETTINGS = [
+    ["block_size", "8192", None, "integer"],
+    ["shared_buffers", "16384", "8kB", "integer"],
+    ["work_mem", "4096", "kB", "integer"],
+    ["hash_mem_multiplier", "2", None, "real"],
+    ["effective_cache_size", "524288", "8kB", "integer"],
+    ["seq_page_cost", "1", None, "real"],
+    ["random_page_cost", "4", None, "real"],
+    ["cpu_tuple_cost", "0.01", None, "real"],
+    ["cpu_index_tuple_cost", "0.005", None, "real"],
+    ["cpu_operator_cost", "0.0025", None, "real"],
+    ["parallel_setup_cost", "1000", None, "real"],
+    ["parallel_tuple_cost", "0.1", None, "real"],
+    ["max_parallel_workers_per_gather", "2", None, "integer"],
+]
+
+
+class FakeServer(object):
+    """
+    Stands in for PostgreSQL behind psycopg2.connect. Every relation has
+    `tuples` tuples in `blocks` blocks and every attribute 25 distinct values.
+    EXPLAIN returns the plan of the query in `plans`
+    """
+
+    def __init__(self, tuples=1000, blocks=10):
+        self.tuples = tuples
+        self.blocks = blocks
+        self.plans = {}
+        self.connections = []
+        self.queries = []
+        self._lock = threading.Lock()
+
+    def connect(self, **kwargs):
+        connection = FakeConnection(self, kwargs.get("dbname"), kwargs.get("async_", False))
+        with self._lock:
+            self.connections.append(connection)
+        return connection
+
+    def rows(self, query):
+        """
+        @return: The rows of the result of query
+        """
+        query = " ".join(query.split())
+        explain = re.fullmatch(r"EXPLAIN \(.*?\) (.*)", query)
+        if explain is not None and explain.group(1) in self.plans:
+            return [([{"Plan": self.plans[explain.group(1)]}],)]
+        if "FROM (VALUES" in query:
+            pairs = re.findall(r"\('(\w+)'::text, (?:'(\w+)'|NULL)::text\)", query)
+            return [
+                (rel, attr or None, float(self.tuples), self.blocks, self.blocks, self.tuples, 25 if attr else None, SETTINGS)
+                for rel, attr in pairs
+            ]
+        if "pg_settings" in query:
+            return [tuple(row) for row in SETTINGS]
+        if "pg_database" in query:
+            return [("postgres",), ("tpch",)]
+        if "COUNT(DISTINCT" in query:
+            return [(25,)]
+        if "COUNT(*)" in query:
+            return [(self.tuples,)]
+        if "reltuples" in query:
+            return [(float(self.tuples), self.blocks, self.blocks, self.tuples)]
+        if "pg_relation_size" in query:
+            return [(self.blocks,)]
+        return [(1,)]
+
+
+class FakeConnection(object):
+    """
+    A connection to a FakeServer. Its queries fail once it is broken.
+    In asynchronous mode every operation is already done when polled
+    """
+
+    def __init__(self, server, dbname, async_=False):
+        self.server = server
+        self.dbname = dbname
+        self.async_ = async_
+        self.closed = 0
+        self.broken = False
+
+    def poll(self):
+        return psycopg2.extensions.POLL_OK
+
+    def fileno(self):
+        return -1
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def cancel(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+class FakeCursor(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self._rows = []
+
+    def execute(self, query, params=None):
+        if self.connection.broken:
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+        server = self.connection.server
+        with server._lock:
+            server.queries.append(query)
+        self._rows = server.rows(query)
+
+    def fetchall(self):
+        return self._rows
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def scan(relation, **fields):
+    """
+    @return: The JSON of a Seq Scan on relation, as EXPLAIN (FORMAT JSON) prints it
+    """
+    return dict(
+        {
+            "Node Type": "Seq Scan",
+            "Relation Name": relation,
+            "Alias": relation,
+            "Startup Cost": 0.0,
+            "Total Cost": 12.5,
+            "Plan Rows": 1000,
+            "Plan Width": 32,
+        },
+        **fields,
+    )
+
+
+class FakeServerTestCase(unittest.TestCase):
+    """
+    Connects explain.py to a FakeServer, with empty caches and pools
+    """
+
+    def setUp(self):
+        self.connect(FakeServer())
+        caches = (stats_cache, subtree_cache, explanation_cache)
+        for cleanup in [close_all_pools] + [cache.invalidate for cache in caches]:
+            cleanup()
+            self.addCleanup(cleanup)
+
+    def connect(self, server):
+        """
+        Connect to server from now on
+        """
+        self.server = server
+        patcher = mock.patch("psycopg2.connect", server.connect)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tree(self, plan, options=ESTIMATE_ONLY, **kwargs):
+        """
+        @return: The Tree of plan, see initialize_tree()
+        """
+        query_details = QueryDetails(database="tpch", query="SELECT 1")
+        return initialize_tree(plan, LOGIN, query_details, options=options, **kwargs)
+
+    def explain(self, plan, options=ESTIMATE_ONLY, **kwargs):
+        """
+        @return: The explanation of plan, see load_qep_explanations()
+        """
+        return load_qep_explanations(self.tree(plan, options, **kwargs))
+
+
+def hash_join(outer, inner, **fields):
+    """
+    @return: The JSON of a Hash Join of two plans on their first columns
+    """
+    outer = dict(outer, **{"Parent Relationship": "Outer"})
+    inner = dict(inner, **{"Parent Relationship": "Inner"})
+    hash = {
+        "Node Type": "Hash",
+        "Total Cost": inner["Total Cost"],
+        "Plan Rows": inner["Plan Rows"],
+        "Plan Width": inner["Plan Width"],
+        "Parent Relationship": "Inner",
+        "Plans": [inner],
+    }
+    return dict(
+        {
+            "Node Type": "Hash Join",
+            "Join Type": "Inner",
+            "Hash Cond": "(" + outer["Relation Name"] + ".id = " + inner["Relation Name"] + ".id)",
+            "Total Cost": outer["Total Cost"] + inner["Total Cost"],
+            "Plan Rows": 1000,
+            "Plan Width": 64,
+            "Plans": [outer, hash],
+        },
+        **fields,
+    )
+
+
+class NormalizeQueryTest(unittest.TestCase):
+    def assertSameKey(self, first, second):
+        self.assertEqual(normalize_query(first), normalize_query(second))
+
+    def assertDifferentKeys(self, first, second):
+        self.assertNotEqual(normalize_query(first), normalize_query(second))
+
+    def test_whitespace_case_and_semicolons(self):
+        self.assertEqual(normalize_query("SELECT *\n\tFROM  Nation ;; "), "select * from nation")
+
+    def test_comments(self):
+        self.assertSameKey("SELECT 1 -- one\nFROM t", "select 1 from t")
+        self.assertSameKey("SELECT /* all\ncolumns */ * FROM t", "select * from t")
+        self.assertSameKey("SELECT 1 -- trailing comment", "select 1")
+
+    def test_comment_markers_inside_literals(self):
+        self.assertDifferentKeys("SELECT '--a' FROM t", "SELECT '' FROM t")
+        self.assertDifferentKeys("SELECT '/* a */' FROM t", "SELECT '' FROM t")
+
+    def test_literals_and_identifiers_are_verbatim(self):
+        self.assertEqual(normalize_query("SELECT 'A  B', \"Col  X\""), "select 'A  B', \"Col  X\"")
+        self.assertEqual(normalize_query("SELECT 'it''s  A'"), "select 'it''s  A'")
+        self.assertDifferentKeys("SELECT 'A'", "SELECT 'a'")
+
+    def test_dollar_quotes(self):
+        self.assertEqual(normalize_query("SELECT $$A  B$$"), "select $$A  B$$")
+        self.assertEqual(normalize_query("SELECT $tag$ A $$ B $tag$ AS X"), "select $tag$ A $$ B $tag$ as x")
+        self.assertDifferentKeys("SELECT $q$A  B$q$", "SELECT $q$a b$q$")
+
+    def test_parameters(self):
+        self.assertEqual(
+            normalize_query("SELECT * FROM T WHERE A = $1 AND B=$2"),
+            "select * from t where a = $1 and b=$2",
+        )
+        self.assertEqual(normalize_query("SELECT $1$2 FROM  T"), "select $1$2 from t")
+
+    def test_dollar_in_identifiers(self):
+        self.assertEqual(normalize_query("SELECT A$B$  FROM T"), "select a$b$ from t")
+
+    def test_escape_strings(self):
+        self.assertDifferentKeys("SELECT * FROM nation WHERE n_name = E'AB\\'  CD'", "SELECT * FROM nation WHERE n_name = E'AB\\' cd'")
+        self.assertEqual(normalize_query("SELECT E'A\\'  B'  FROM T"), "select e'A\\'  B' from t")
+        self.assertEqual(normalize_query("SELECT e'A\\\\' ,  'B'"), "select e'A\\\\' , 'B'")
+        self.assertSameKey("SELECT E'A'", "select e'A'")
+
+    def test_typed_literals(self):
+        self.assertEqual(normalize_query("SELECT DATE'2020-01-01'"), "select date'2020-01-01'")
+
+    def test_unsure_literals_are_not_normalized(self):
+        # A backslash in a plain string depends on standard_conforming_strings
+        query = "SELECT 'AB\\'  FROM  T"
+        self.assertEqual(normalize_query(query), query)
+
+        for query in ("SELECT 'AB  FROM T", "SELECT E'AB\\'  FROM T", 'SELECT "AB  FROM T'):
+            self.assertEqual(normalize_query(query), query)
+
+
+class SamplePercentTest(unittest.TestCase):
+    def test_from_statistics(self):
+        self.assertAlmostEqual(sample_percent(10000, 1000000, 30000), 3.0)
+
+    def test_small_relation_is_read_whole(self):
+        self.assertEqual(sample_percent(10, 1000, 30000), 100.0)
+        self.assertEqual(sample_percent(0, 0, 30000), 100.0)
+
+    def test_never_analyzed_relation_is_not_read_whole(self):
+        # T() is 0 without statistics, the blocks are exact
+        self.assertLess(sample_percent(1000000, 0, 30000), 1.0)
+        self.assertEqual(sample_percent(10, 0, 30000), 100.0)
+
+    def test_capped(self):
+        self.assertEqual(sample_percent(1000, 100000, 30000), MAX_SAMPLE_PERCENT)
+
+
+class PlanCacheTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "plans.json")
+
+    def test_saved_entries_are_loaded(self):
+        query_data = [[[{"Plan": scan("nation")}]]]
+        PlanCache(self.path).put("key", query_data)
+        self.assertEqual(PlanCache(self.path).get("key")[0], query_data)
+
+    def test_too_deep_entry_is_not_saved(self):
+        deep = scan("nation")
+        for _ in range(sys.getrecursionlimit()):
+            deep = {"Node Type": "Limit", "Total Cost": 1.0, "Plans": [deep]}
+
+        cache = PlanCache(self.path)
+        cache.put("deep", [[[{"Plan": deep}]]])
+        cache.put("flat", [[[{"Plan": scan("nation")}]]])
+        cache.save()
+        self.assertIsNotNone(cache.get("deep"))
+
+        cache = PlanCache(self.path)
+        self.assertIsNone(cache.get("deep"))
+        self.assertIsNotNone(cache.get("flat"))
+
+    def test_malformed_file_is_ignored(self):
+        for content in ('[["key", 1]]', '{"key": 1}', '[["key", [], "now"]]', "[[1, [], 0]]", "[1]", "[", ""):
+            with open(self.path, "w") as file:
+                file.write(content)
+            cache = PlanCache(self.path)
+            self.assertEqual(cache.stats()["entries"], 0, content)
+
+    def test_old_entries_are_skipped(self):
+        with open(self.path, "w") as file:
+            json.dump([["old", [], 0], ["new", [], time.time()]], file)
+        cache = PlanCache(self.path)
+        self.assertIsNone(cache.get("old"))
+        self.assertIsNotNone(cache.get("new"))
+
+
+class SortNodeTest(FakeServerTestCase):
+    def sort(self, **fields):
+        return dict(
+            {
+                "Node Type": "Sort",
+                "Sort Key": ["nation.n_name"],
+                "Total Cost": 80.0,
+                "Plan Rows": 1000,
+                "Plan Width": 32,
+                "Plans": [scan("nation", **{"Parent Relationship": "Outer"})],
+            },
+            **fields,
+        )
+
+    def test_sort_method_of_analyze(self):
+        output = self.explain(self.sort(**{"Sort Method": "external merge"}))
+        self.assertIn("Mergesort Formula", output)
+        self.assertNotIn("only known under ANALYZE", output)
+
+    def test_estimate_only_predicts_sort_method(self):
+        # 1000 tuples of 32 bytes fit in work_mem
+        output = self.explain(self.sort())
+        self.assertIn("only known under ANALYZE, quicksort is predicted", output)
+        self.assertIn("Calculated Cost: 10", output)
+
+        # 1000 tuples of 8 kB do not
+        output = self.explain(self.sort(**{"Plan Width": 8192}))
+        self.assertIn("external merge is predicted", output)
+        self.assertIn("Calculated Cost: 30", output)
+
+
+class ShapeCacheTest(FakeServerTestCase):
+    def plan(self, price, segment, cost):
+        return hash_join(
+            scan("orders", Filter="(o_totalprice > " + price + ")", **{"Total Cost": cost}),
+            scan("customer", Filter="(c_mktsegment = '" + segment + "'::bpchar)"),
+        )
+
+    def test_literals_do_not_change_the_fingerprint(self):
+        fingerprint = self.tree(self.plan("1000", "BUILDING", 20.0)).fingerprint()
+        self.assertEqual(fingerprint, self.tree(self.plan("2500.5", "MACHINERY", 35.0)).fingerprint())
+
+        # A literal that changes how the condition is parsed is part of the shape
+        self.assertNotEqual(fingerprint, self.tree(self.plan("1000", "A<B", 20.0)).fingerprint())
+        self.assertNotEqual(fingerprint, self.tree(hash_join(scan("orders"), scan("nation"))).fingerprint())
+
+    def test_plans_of_the_same_shape_share_estimates(self):
+        self.explain(self.plan("1000", "BUILDING", 20.0))
+        tree = self.tree(self.plan("2500.5", "MACHINERY", 12.5))
+        shared = load_qep_explanations(tree)
+        self.assertEqual((tree.nodes_recomputed, tree.nodes_shared), (0, 4))
+        self.assertIn("0 recomputed, 0 reused from a previous run, 4 from a plan of the same shape", shared)
+
+        # Only the costs of PostgreSQL differ, which are not shared
+        self.assertIn("PostgreSQL Total Cost: 12.5\nManually calculated cost is different", shared)
+        self.assertEqual(tree.root.children[0].parent_dict["postgre_cost"], 12.5)
+
+        subtree_cache.invalidate()
+        explanation_cache.invalidate()
+        fresh = self.explain(self.plan("2500.5", "MACHINERY", 12.5))
+        self.assertTrue(shared.startswith(fresh + "\n"))
+
+
+class SubtreeCacheTest(FakeServerTestCase):
+    def test_explanations_do_not_outlive_statistics(self):
+        self.assertLessEqual(subtree_cache.ttl, stats_cache.ttl)
+        self.assertLessEqual(explanation_cache.ttl, stats_cache.ttl)
+
+    def test_rerun_reuses_subtrees(self):
+        plan = hash_join(scan("orders"), scan("customer"))
+        first = self.explain(plan)
+        tree = self.tree(plan)
+        rerun = load_qep_explanations(tree)
+        self.assertEqual((tree.nodes_recomputed, tree.nodes_reused), (0, 4))
+        self.assertTrue(rerun.startswith(first + "\n"))
+
+    def test_invalidated_statistics_are_explained_again(self):
+        plan = hash_join(scan("orders"), scan("customer"))
+        self.assertIn("Number of blocks for relation 'orders': 10\n", self.explain(plan))
+
+        self.server.blocks = 50
+        stats_cache.invalidate(stats_database(LOGIN, "tpch"), "orders")
+        tree = self.tree(plan)
+        output = load_qep_explanations(tree)
+        self.assertIn("Number of blocks for relation 'orders': 50\n", output)
+        self.assertEqual((tree.nodes_reused, tree.nodes_shared), (0, 0))
+
+
+class RequestServer(FakeServer):
+    """
+    Answers SELECT i AS request with i, and its EXPLAIN with a plan whose
+    Output is i, like EXPLAIN VERBOSE does. The answers are those of request
+    i + shift, to check that a mixed up request is noticed
+    """
+
+    def __init__(self, shift=0):
+        super().__init__()
+        self.shift = shift
+
+    def rows(self, query):
+        match = re.search(r"SELECT (\d+) AS request", query)
+        if match is None:
+            return super().rows(query)
+
+        # Let the requests of the other threads run in between
+        time.sleep(random.random() / 1000)
+
+        i = int(match.group(1)) + self.shift
+        if not query.startswith("EXPLAIN"):
+            return [(i,)]
+        plan = {
+            "Node Type": "Result",
+            "Startup Cost": 0.0,
+            "Total Cost": 0.01,
+            "Plan Rows": 1,
+            "Plan Width": 4,
+            "Output": [str(i)],
+        }
+        return [([{"Plan": plan}],)]
+
+
+class ConcurrentRequestsTest(FakeServerTestCase):
+    def run_requests(self, num_threads=16, num_requests=200):
+        """
+        Run num_requests different queries on num_threads threads at the same
+        time, each request with its own QueryDetails
+
+        @return: The number of requests that got the result or the plan of another
+        """
+
+        def run(i):
+            query_details = QueryDetails(database="tpch", query="SELECT " + str(i) + " AS request")
+            rows = retrieve_query(LOGIN, query_details, explain=False)
+            qep, _ = retrieve_plan(LOGIN, query_details, refresh=True)
+            tree = initialize_tree(qep[0][0][0]["Plan"], LOGIN, query_details)
+            load_qep_explanations(tree)
+            return rows == [(i,)] and tree.root.node_json.get("Output") == [str(i)]
+
+        # retrieve_query prints every query and result
+        with contextlib.redirect_stdout(io.StringIO()):
+            with ThreadPoolExecutor(num_threads) as executor:
+                return list(executor.map(run, range(num_requests))).count(False)
+
+    def test_every_request_gets_its_own_result(self):
+        self.connect(RequestServer())
+        self.assertEqual(self.run_requests(), 0)
+
+    def test_mixed_up_requests_are_noticed(self):
+        self.connect(RequestServer(shift=1))
+        self.assertEqual(self.run_requests(num_requests=50), 50)
+
+
+class ParallelExplainTest(FakeServerTestCase):
+    def plan(self):
+        """
+        @return: An Append of two joins and of an Append of partitions
+        """
+        partitions = [scan("orders_" + str(i)) for i in range(4)]
+        return {
+            "Node Type": "Append",
+            "Total Cost": 150.0,
+            "Plan Rows": 6000,
+            "Plan Width": 64,
+            "Plans": [
+                hash_join(scan("orders"), scan("customer")),
+                hash_join(scan("lineitem"), scan("part")),
+                {"Node Type": "Append", "Total Cost": 50.0, "Plan Rows": 4000, "Plan Width": 32, "Plans": partitions},
+            ],
+        }
+
+    def test_parallel_output_is_sequential_output(self):
+        # Exact counts make every scan query the database
+        sequential = self.explain(self.plan(), exact_counts=True)
+        connections = len(self.server.connections)
+
+        stats_cache.invalidate()
+        tree = self.tree(self.plan(), exact_counts=True, max_workers=4)
+        self.assertEqual(load_qep_explanations(tree), sequential)
+        self.assertEqual(tree.nodes_recomputed, sum(1 for _ in tree.iter_nodes()))
+        self.assertGreater(len(self.server.connections), connections)
+
+
+class HealthCheckServer(FakeServer):
+    """
+    Holds the health checks of the pool, SELECT 1, until released
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.checking = threading.Event()
+        self.released = threading.Event()
+
+    def rows(self, query):
+        if query == "SELECT 1":
+            self.checking.set()
+            self.released.wait(5)
+        return super().rows(query)
+
+
+class ConnectionPoolTest(FakeServerTestCase):
+    def test_idle_connection_is_reused(self):
+        pool = ConnectionPool(LOGIN, "tpch")
+        connection = pool.getconn()
+        pool.putconn(connection)
+        self.assertIs(pool.getconn(), connection)
+        self.assertEqual((pool.hits, pool.misses), (1, 1))
+
+    def test_broken_connection_is_discarded(self):
+        # Health-check every idle connection
+        pool = ConnectionPool(LOGIN, "tpch", check_after=-1)
+        connection = pool.getconn()
+        pool.putconn(connection)
+        connection.broken = True
+
+        self.assertIsNot(pool.getconn(), connection)
+        self.assertTrue(connection.closed)
+        self.assertEqual(pool.stats()["discarded"], 1)
+        self.assertEqual(pool.stats()["size"], 1)
+
+    def test_health_check_does_not_block_other_threads(self):
+        self.connect(HealthCheckServer())
+        pool = ConnectionPool(LOGIN, "tpch", check_after=-1, max_size=2)
+        connection = pool.getconn()
+        pool.putconn(connection)
+
+        checked = []
+        thread = threading.Thread(target=lambda: checked.append(pool.getconn()))
+        thread.start()
+        self.assertTrue(self.server.checking.wait(5))
+
+        # Another thread opens a new connection meanwhile
+        start = time.monotonic()
+        self.assertIsNot(pool.getconn(timeout=2), connection)
+        self.assertLess(time.monotonic() - start, 1)
+
+        self.server.released.set()
+        thread.join()
+        self.assertEqual(checked, [connection])
+
+
+class AnalyzeServer(FakeServer):
+    """
+    Holds EXPLAIN ANALYZE until the statistics of the relations are fetched, for at most 5 s
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.prefetched = threading.Event()
+        self.overlapped = None
+
+    def rows(self, query):
+        rows = super().rows(query)
+        if "FROM (VALUES" in query:
+            self.prefetched.set()
+        elif query.startswith("EXPLAIN (ANALYZE"):
+            self.overlapped = self.prefetched.wait(5)
+        return rows
+
+
+class PrefetchTest(FakeServerTestCase):
+    QUERY = "SELECT * FROM orders JOIN customer USING (id)"
+
+    def test_statistics_are_fetched_while_the_query_runs(self):
+        self.connect(AnalyzeServer())
+        self.server.plans[self.QUERY] = hash_join(scan("orders"), scan("customer"))
+        query_details = QueryDetails(database="tpch", query=self.QUERY)
+        with contextlib.redirect_stdout(io.StringIO()):
+            qep, _ = retrieve_plan(LOGIN, query_details, EXPLAIN_ANALYZE, refresh=True)
+        self.assertTrue(self.server.overlapped)
+
+        # The tree of the plan finds every statistic it needs
+        queries = len(self.server.queries)
+        initialize_tree(qep[0][0][0]["Plan"], LOGIN, query_details).close()
+        self.assertFalse([query for query in self.server.queries[queries:] if "FROM (VALUES" in query])
+
+
+class ExplainAsyncTest(FakeServerTestCase):
+    QUERY = "SELECT * FROM orders JOIN customer USING (id)"
+
+    def test_nodes_query_the_async_session(self):
+        plan = hash_join(scan("orders"), scan("customer"))
+        self.server.plans[self.QUERY] = plan
+        output = asyncio.run(explain_async(LOGIN, self.QUERY, "tpch", ESTIMATE_ONLY, exact_counts=True, refresh=True))
+
+        # The tuples are counted through the BlockingSession, on the one connection of explain_async
+        self.assertEqual([connection.async_ for connection in self.server.connections], [True])
+        self.assertTrue([query for query in self.server.queries if "COUNT(*)" in query])
+
+        subtree_cache.invalidate()
+        explanation_cache.invalidate()
+        self.assertEqual(output, self.explain(plan, exact_counts=True))
+
+
+class LoginTest(FakeServerTestCase):
+    def test_blocking_functions_inside_an_event_loop(self):
+        async def login():
+            return check_connection(LOGIN, "tpch"), get_database_names(LOGIN), get_database_names(LOGIN)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            connected, names, _ = asyncio.run(login())
+        self.assertTrue(connected)
+        self.assertEqual(names, ["postgres", "tpch"])
+
+        # One connection to check the login, the database names reuse a pooled one
+        self.assertEqual([connection.async_ for connection in self.server.connections], [False, False])
+
+    def test_async_functions(self):
+        self.assertTrue(asyncio.run(check_connection_async(LOGIN, "tpch")))
+        self.assertEqual(asyncio.run(get_database_names_async(LOGIN)), ["postgres", "tpch"])
+
+
+if __name__ == "__main__":
+    unittest.main()